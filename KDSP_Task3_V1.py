@@ -1,67 +1,896 @@
-import pandas as pd
+import time
+_import_start = time.perf_counter()
 import numpy as np
 import math
-from sklearn.cluster import KMeans
-from sklearn.metrics.pairwise import cosine_similarity
-import folium
-
-PATH = "Project3_Data\dataset_NYC.txt"
+import hashlib
+import io
+import os
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from lazy_import import lazyModule
+# pandas and scipy.sparse are loaded on first use; sklearn (clusterCategories) and folium (showMap) only where needed
+pd = lazyModule('pandas')
+sparse = lazyModule('scipy.sparse')
+import dataset_cache
+import shards
+from spatial import VenueIndex, distanceMatrixKm, geometricMedian, minimaxPoint
+from ann import HyperplaneLSH
+from category_index import CategoryIndex
+from result_cache import ResultCache
+import metrics
+
+# datasets served, one shard per city (see shards.py); CITY is loaded at start, the others on their first request
+REGISTRY = shards.readRegistry(os.environ.get('KDSP_REGISTRY', shards.REGISTRY_PATH))
+CITY = os.environ.get('KDSP_CITY', REGISTRY['default'])
+# check-in file of CITY (KDSP_DATASET selects another one, e.g. a synthetic dataset from synthetic_data.py)
+PATH = os.environ.get('KDSP_DATASET', REGISTRY['cities'][CITY]['path'])
+# precomputed tables of PATH: the city's, or for another file its own, next to it (<file>_neighbours.npz, <file>_clusters.npz)
+ARTIFACTS = (REGISTRY['cities'][CITY] if os.path.abspath(PATH) == os.path.abspath(REGISTRY['cities'][CITY]['path'])
+             else shards.artifactPaths(os.path.splitext(PATH)[0]))
+# memory budget (MB) of the other cities' shards
+SHARDS_MB = float(os.environ.get('KDSP_SHARDS_MB', 2048))
+# distance (degrees) a Task 3 location may be outside the box of a city's venues
+LOCATION_MARGIN = 0.5
+NEIGHBOURS_PATH = ARTIFACTS['neighbours']
+# number of neighbours kept per user in the precomputed neighbour table
+NEIGHBOURS_N = 50
+# Task 2 search without a neighbour table: 'exact' (every user scored) or 'lsh' (approximate, for very many users: see ann.py)
+SIMILAR_USERS = os.environ.get('KDSP_SIMILAR_USERS', 'exact')
+# LSH parameters: hash bits per table, number of tables, probes (1 = also the buckets one bit away); see lsh_recall.py
+LSH_BITS = int(os.environ.get('KDSP_LSH_BITS', 16))
+LSH_TABLES = int(os.environ.get('KDSP_LSH_TABLES', 8))
+LSH_PROBES = int(os.environ.get('KDSP_LSH_PROBES', 1))
+CLUSTERS_PATH = ARTIFACTS['clusters']
+# Task 3: centre the venues are searched around ('median': least total travel, 'minimax': least longest travel,
+# 'mean': the average of the locations), venues scored around it, and the extra travel (km, per user on average
+# or for the farthest user with 'minimax') worth one more user who often visits the venue's category
+MEETING_CENTER = os.environ.get('KDSP_MEETING_CENTER', 'median')
+MEETING_CANDIDATES = 1000
+MEETING_KM_PER_USER = 1.0
+# bump when clusterCategories changes, so cluster tables saved by older code are refit
+CLUSTERS_VERSION = 1
+CLUSTERS_SEED = 0
+# share of a table the rows appended since it was built may reach before they are merged into it
+# (the tail of the time index, the VenueIDs of appended venues)
+FOLD_SHARE = 0.02
+# memory budget (MB) and lifetime (s) of the in-memory result cache
+RESULT_CACHE_MB = float(os.environ.get('KDSP_CACHE_MB', 64))
+RESULT_CACHE_TTL = float(os.environ.get('KDSP_CACHE_TTL', 3600))
+# memory budget (MB) of the Task 3 maps kept for /map/<map_id>
+MAP_CACHE_MB = float(os.environ.get('KDSP_MAP_CACHE_MB', 32))
 columns = ['UserID', 'VenueID', 'VenueCategoryID', 'VenueCategoryName', 'Latitude', 'Longitude', 'TimezoneOffsetInMin',
            'UTCTime']
-df = pd.read_csv(PATH, sep="\t", encoding_errors='ignore', names=columns)
+
+
+# Function that parses the original tab separated check-in file
+def readCheckins(path):
+    return pd.read_csv(path, sep="\t", encoding_errors='ignore', names=columns)
+
+
+# the check-in log is loaded on first use (kdsp.df, or the first recommendation), or by warmup():
+# importing the module only reads the settings. the parsed file is converted once to a columnar binary cache
+# (see dataset_cache.py) and opened from it afterwards
+# (df is the check-in log as loaded: rows added later with appendCheckins only go into the derived tables)
+_load_lock = threading.RLock()
+# startup time breakdown (s), see startupReport()
+_startup = {'import_s': None, 'dataset_s': None}
+# sorted distinct UserIDs of the check-in log, see datasetUserIDs()
+_user_ids = None
+
+
+# Function that loads the check-in log (once) and returns it
+def loadCheckins():
+    global df, memory_report
+    with _load_lock:
+        if 'df' not in globals():
+            start = time.perf_counter()
+            data, memory_report = dataset_cache.loadDataset(PATH, readCheckins)
+            df = data
+            _startup['dataset_s'] = time.perf_counter() - start
+            # (on stderr: stdout is left to the tools writing results, e.g. recommend_stream.py)
+            print("dataset: %.1f MB resident (%.1f MB saved against the text file)"
+                  % (memory_report['resident_bytes'] / 2**20, memory_report['saved_bytes'] / 2**20), file=sys.stderr)
+    return df
+
+
+# Function that returns the sorted distinct UserIDs of the check-in log as loaded (read once from the dataset cache,
+# without loading the check-ins: see checkUserID)
+def datasetUserIDs():
+    global _user_ids
+    with _load_lock:
+        if _user_ids is None:
+            _user_ids = dataset_cache.loadUserIDs(PATH, readCheckins)
+    return _user_ids
+
+
+# df and memory_report are loaded when they are first read
+def __getattr__(name):
+    if name in ('df', 'memory_report'):
+        loadCheckins()
+        return globals()[name]
+    raise AttributeError("module " + __name__ + " has no attribute " + name)
+
+
+############################## tables derived from the check-in log
+# every table lives in one snapshot (dict). appendCheckins builds a new snapshot and replaces the current one;
+# the recommenders pin one snapshot per call (see pinned()), so they never mix tables of two versions.
+# the first snapshot is built on first use (or by warmup()), and each of its tables only when it is first read
+# (see LazyTables): a process answering only Task 2 never builds the venue index or fits the category clusters.
+
+snapshot = None
+# set by freeze(): the snapshot is shared by forked workers and never replaced
+frozen = False
+_local = threading.local()
+# appends are applied one at a time
+_append_lock = threading.Lock()
+
+
+# Function that loads the check-in log and builds the snapshot if it is not loaded yet, and returns the snapshot
+# called on first use of the tables; call it explicitly to pay the loading cost up front (e.g. before serving)
+# full=True also builds every table otherwise built on its first use
+def warmup(full=False):
+    global snapshot
+    with _load_lock:
+        if snapshot is None:
+            snapshot = buildTables(loadCheckins())
+    if full and isinstance(snapshot, LazyTables):
+        snapshot.build()
+    return snapshot
+
+
+# Function that returns the startup time breakdown (s): module import, dataset load, and the build of each table
+# of the first snapshot built so far (counts first)
+def startupReport():
+    report = dict(_startup)
+    first = snapshot if isinstance(snapshot, LazyTables) else None
+    report['tables_s'] = dict(first.seconds) if first is not None else {}
+    return report
+
+
+# Function that tells whether the snapshot of the default city is loaded and all its tables are built
+def ready():
+    return snapshot is not None and (not isinstance(snapshot, LazyTables) or snapshot.built())
+
+
+# placeholder pinned by pinned(lazy=True): the current snapshot is pinned on its first read
+_PIN_LATER = object()
+
+
+# Function that returns the snapshot pinned by the running call, or the current one
+def tables():
+    shard = getattr(_local, 'pinned', None)
+    if shard is _PIN_LATER:
+        shard = _local.pinned = snapshot or warmup()
+    return shard or snapshot or warmup()
+
+
+# Function (context manager) that pins a snapshot (default: the current one) for the calling thread until the block ends
+# nested pins keep the outermost snapshot
+# lazy=True (default snapshot only): the snapshot is pinned on the first read of tables(), so a call that ends
+# before it needs the tables (e.g. a rejected UserID, see checkUserID) does not load them (nothing is yielded)
+@contextmanager
+def pinned(shard=None, lazy=False):
+    outer = getattr(_local, 'pinned', None)
+    if outer is _PIN_LATER:
+        outer = tables()
+    if outer is None and shard is None and lazy:
+        _local.pinned = _PIN_LATER
+    else:
+        _local.pinned = outer or shard or snapshot or warmup()
+    try:
+        yield None if _local.pinned is _PIN_LATER else _local.pinned
+    finally:
+        _local.pinned = outer
+
+
+# Function that tells whether the running call can be answered without the tables (none pinned or loaded yet)
+def tablesPending():
+    return snapshot is None and getattr(_local, 'pinned', None) in (None, _PIN_LATER)
+
+
+# Function that makes the current snapshot read-only before worker processes are forked (serving mode, see serve.py)
+# numeric arrays are made contiguous and write-protected, so the workers share their pages copy-on-write;
+# appendCheckins is refused afterwards (each worker would otherwise drift to its own version of the data)
+def freeze():
+    global frozen
+    with _append_lock:
+        frozen = True
+        for shard in [warmup(full=True)] + registry.loadedTables():
+            for table in shard.values():
+                if isinstance(table, dict):
+                    for key, value in table.items():
+                        table[key] = readOnly(value)
+                else:
+                    readOnly(table)
+    return snapshot
+
+
+def readOnly(value):
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        value.setflags(write=False)
+    elif isinstance(value, sparse.csr_matrix):
+        for array in (value.data, value.indices, value.indptr):
+            array.setflags(write=False)
+    return value
+
+
+# Snapshot whose tables are built on their first read: builders {key: function(tables) -> table}
+# (reads with [] build a missing table; build() builds every one, e.g. before the tables are shared or copied)
+class LazyTables(dict):
+
+    def __init__(self, tables, builders, seconds=None):
+        super().__init__(tables)
+        self.builders = builders
+        # build time (s) of each table
+        self.seconds = dict(seconds or {})
+        self.lock = threading.RLock()
+
+    def __missing__(self, key):
+        if key not in self.builders:
+            raise KeyError(key)
+        # one build per table; a builder may read the other tables (re-entrant lock)
+        with self.lock:
+            if not dict.__contains__(self, key):
+                start = time.perf_counter()
+                self[key] = self.builders[key](self)
+                self.seconds[key] = time.perf_counter() - start
+            return dict.__getitem__(self, key)
+
+    def build(self):
+        for key in self.builders:
+            self[key]
+        return self
+
+    def built(self):
+        return all(dict.__contains__(self, key) for key in self.builders)
+
+
+# Function that builds the derived tables of the check-in log: the count store now, the other tables on first use
+@metrics.timed()
+def buildTables(data, neighbours_path=NEIGHBOURS_PATH, clusters_path=CLUSTERS_PATH):
+    start = time.perf_counter()
+    counts = buildCountStore(data)
+    fingerprint = datasetFingerprint(counts)
+
+    return LazyTables({'version': 0, 'fingerprint': fingerprint, 'counts': counts}, {
+        'category_index': lambda t: buildCategoryIndex(t['counts']),
+        'venues': lambda t: buildVenueTable(data, t['counts']),
+        # unique venues and their coordinates, indexed for nearest / radius queries (Task 3)
+        'venue_index': lambda t: VenueIndex(t['venues']['table']),
+        'user_vectors': lambda t: buildUserVectors(t['counts']['by_name']),
+        'user_lsh': lambda t: buildUserLSH(t['user_vectors']) if SIMILAR_USERS == 'lsh' else None,
+        'neighbours': lambda t: loadNeighbourTable(t['fingerprint'], neighbours_path),
+        'category_clusters': lambda t: loadCategoryClusters(t['counts'], t['fingerprint'], clusters_path),
+        'bounds': lambda t: datasetBounds(t['counts'], t['venues']),
+        'time_index': lambda t: buildTimeIndex(data, t['counts'], t['venues']),
+    }, {'counts': time.perf_counter() - start})
+
+
+# Function that returns the range of the UserIDs and of the venue coordinates of a dataset (input validation)
+def datasetBounds(counts, venues):
+    table = venues['table']
+    return {
+        'users': [int(counts['user_ids'].min()), int(counts['user_ids'].max())],
+        'latitude': [float(table['Latitude'].min()), float(table['Latitude'].max())],
+        'longitude': [float(table['Longitude'].min()), float(table['Longitude'].max())],
+    }
+
+
+# Function that returns dataset bounds with new UserIDs and venue rows added
+def extendedBounds(bounds, user_ids, venue_rows):
+    added = {'users': np.asarray(user_ids), 'latitude': venue_rows['Latitude'].to_numpy(),
+             'longitude': venue_rows['Longitude'].to_numpy()}
+    cast = {'users': int, 'latitude': float, 'longitude': float}
+    return {key: [cast[key](min(low, added[key].min())), cast[key](max(high, added[key].max()))] if len(added[key]) > 0
+            else [low, high] for key, (low, high) in bounds.items()}
+
+
+# Function that builds the user x category count matrices once from the check-in log
+# rows: UserID, columns: VenueCategoryID / VenueCategoryName (sorted at load; values first seen in appended rows go at the end)
+# values: number of check-ins. matrices are sparse (CSR), so one user's counts can be read from a single row
+def buildCountStore(data):
+    user_codes, user_ids = pd.factorize(data['UserID'], sort=True)
+    id_codes, category_ids = pd.factorize(data['VenueCategoryID'], sort=True)
+    name_codes, category_names = pd.factorize(data['VenueCategoryName'], sort=True)
+    ones = np.ones(len(data), dtype=np.int32)
+
+    # duplicated (user, category) pairs are summed while converting to CSR
+    by_id = sparse.csr_matrix((ones, (user_codes, id_codes)), shape=(len(user_ids), len(category_ids)))
+    by_name = sparse.csr_matrix((ones, (user_codes, name_codes)), shape=(len(user_ids), len(category_names)))
+
+    # VenueCategoryName of each VenueCategoryID column (first occurrence in the log)
+    first = pd.Series(np.arange(len(data))).groupby(id_codes).first().values
+    id_names = np.asarray(data['VenueCategoryName'])[first]
+
+    store = makeCountStore(np.asarray(user_ids), np.asarray(category_ids), np.asarray(category_names),
+                           np.asarray(id_names), by_id, by_name)
+    store['checkins'], store['checkin_hash'] = len(data), checkinHash(data)
+    # number of check-ins of each VenueCategoryName (category index ranks)
+    store['name_counts'] = np.bincount(name_codes, minlength=len(category_names))
+    return store
+
+
+def makeCountStore(user_ids, category_ids, category_names, id_names, by_id, by_name):
+    return {
+        'user_ids': user_ids,
+        'user_pos': {uid: i for i, uid in enumerate(user_ids.tolist())},
+        'category_ids': category_ids,
+        'category_names': category_names,
+        'category_id_names': id_names,
+        # value -> column position (vectorized lookups with get_indexer)
+        'id_index': pd.Index(category_ids),
+        'name_index': pd.Index(category_names),
+        'by_id': by_id,
+        'by_name': by_name,
+    }
+
+
+# Function that returns one user's row of the given count matrix as (column indices, counts)
+def getUserCounts(inputUserID, key='by_id'):
+    counts = tables()['counts']
+    pos = counts['user_pos'].get(inputUserID)
+    if pos is None:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+    matrix = counts[key]
+    start, end = matrix.indptr[pos], matrix.indptr[pos + 1]
+    return matrix.indices[start:end], matrix.data[start:end]
+
+
+# Function that builds the venue table: one row per VenueID (first check-in's coordinates), in order of first check-in
+# name_order / name_offsets: venues of category name code c are rows name_order[name_offsets[c]:name_offsets[c + 1]]
+# id_order / id_offsets: the same for VenueCategoryID codes (codes = column positions of the count store)
+# visited: user x venue CSR matrix, the venues each user checked into (rows of the count store)
+def buildVenueTable(data, counts):
+    first = ~data['VenueID'].duplicated().to_numpy()
+    table = newVenueRows(data, first)
+    visited = visitedMatrix(data, counts, pd.Index(table['VenueID']), len(table))
+    name_codes = counts['name_index'].get_indexer(table['VenueCategoryName'])
+    id_codes = counts['id_index'].get_indexer(table['VenueCategoryID'])
+
+    return {
+        'table': table,
+        'venue_pos': pd.Index(table['VenueID']),
+        # VenueIDs of the venues appended since venue_pos was built (rows from len(venue_pos) on), see venueRows
+        'added_pos': pd.Index([], dtype=object),
+        'per': table['per'].to_numpy(),
+        'name_order': np.argsort(name_codes, kind='stable'),
+        'name_offsets': np.searchsorted(np.sort(name_codes), np.arange(len(counts['category_names']) + 1)),
+        'id_order': np.argsort(id_codes, kind='stable'),
+        'id_offsets': np.searchsorted(np.sort(id_codes), np.arange(len(counts['category_ids']) + 1)),
+        'visited': visited,
+    }
+
+
+# Function that returns the venue table rows of VenueIDs (-1 for unknown ones)
+def venueRows(venues, venue_ids):
+    venue_ids = np.asarray(venue_ids)
+    rows = venues['venue_pos'].get_indexer(venue_ids)
+    if len(venues['added_pos']) > 0 and (missing := np.flatnonzero(rows < 0)).size > 0:
+        added = venues['added_pos'].get_indexer(venue_ids[missing])
+        rows[missing] = np.where(added >= 0, added + len(venues['venue_pos']), -1)
+    return rows
+
+
+# Function that returns the selected check-in rows as venue table rows
+def newVenueRows(data, selected):
+    table = pd.DataFrame({
+        'VenueID': np.asarray(data['VenueID'])[selected],
+        'VenueCategoryID': np.asarray(data['VenueCategoryID'])[selected],
+        'VenueCategoryName': np.asarray(data['VenueCategoryName'])[selected],
+        # coordinates may come from the float32 columns of the dataset cache, whose spacing near 74 degrees is about
+        # 7.6e-6 degree (under 1 m): rounding to 6 decimals (the precision of the original file) only hides the float32
+        # noise in the output, the digits lost are not restored
+        'Latitude': np.round(data['Latitude'].to_numpy(dtype=np.float64)[selected], 6),
+        'Longitude': np.round(data['Longitude'].to_numpy(dtype=np.float64)[selected], 6),
+    })
+    # a standard value 'per' as a latitude/longitude ratio (used to drop outlier places in Task 1)
+    table['per'] = table['Latitude'] / table['Longitude']
+    return table
+
+
+def visitedMatrix(data, counts, venue_pos, n_venues):
+    user_rows = np.array([counts['user_pos'][uid] for uid in data['UserID'].tolist()], dtype=np.int64)
+    venue_rows = venue_pos.get_indexer(data['VenueID'])
+    return sparse.csr_matrix((np.ones(len(data), dtype=bool), (user_rows, venue_rows)),
+                      shape=(len(counts['user_ids']), n_venues))
+
+
+# Function that returns the rows of the venue table for the given category codes, category by category (in the given order)
+@metrics.timed()
+def categoryRows(codes, order, offsets):
+    codes = np.asarray(codes, dtype=np.int64)
+    codes = codes[codes >= 0]
+    starts = offsets[codes]
+    lengths = offsets[codes + 1] - starts
+    # position i of category j = starts[j] + (i - first position of category j in the result)
+    return order[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())]
+
+
+# Function that returns a boolean mask over the venue table: True for venues the user checked into
+def visitedMask(inputUserID):
+    t = tables()
+    mask = np.zeros(len(t['venues']['table']), dtype=bool)
+    pos = t['counts']['user_pos'].get(inputUserID)
+    if pos is not None:
+        visited = t['venues']['visited']
+        mask[visited.indices[visited.indptr[pos]:visited.indptr[pos + 1]]] = True
+    return mask
+
+
+# Function that builds the VenueCategoryID <-> VenueCategoryName dictionary and substring index over the names
+def buildCategoryIndex(counts):
+    return CategoryIndex(counts['category_ids'], counts['category_id_names'], counts['category_names'], counts['name_counts'])
+
+
+# Function that returns the category index of a count store with check-ins added (old: the count store before)
+# it is built again only when the batch adds a category; otherwise the names are reranked by their new frequencies
+def updateCategoryIndex(index, old, counts):
+    if len(counts['category_ids']) > len(old['category_ids']) or len(counts['category_names']) > len(old['category_names']):
+        return buildCategoryIndex(counts)
+    if np.array_equal(np.argsort(-old['name_counts'], kind='stable'), np.argsort(-counts['name_counts'], kind='stable')):
+        return index
+    return index.reranked(counts['name_counts'])
+
+
+# Function that returns a short hash of the count store: artifacts built from the data are keyed by it
+# (made from the number of check-ins and their checkinHash, so appending a batch updates it in time of the batch)
+def datasetFingerprint(counts):
+    return hashlib.sha1(('%d:%d' % (counts['checkins'], counts['checkin_hash'])).encode()).hexdigest()[:16]
+
+
+# Function that returns the sum (mod 2**64) of the hashes of the check-ins' (UserID, VenueCategoryID, VenueCategoryName):
+# the same for the same check-ins in any order, so the sum of a log with a batch appended is the log's sum + the batch's
+def checkinHash(data):
+    hashes = pd.util.hash_pandas_object(data[['UserID', 'VenueCategoryID', 'VenueCategoryName']], index=False)
+    return int(hashes.to_numpy().sum(dtype=np.uint64))
+
+
+############################## time index
+# the check-ins sorted by local time (dataset_cache.localTimes): the check-ins of any time window are one slice,
+# found with two binary searches. each check-in keeps the codes it is counted under in the count store.
+# (tail: appended check-ins kept in a small time index of their own, see updateTimeIndex)
+TIME_COLUMNS = ['times', 'user', 'venue', 'category_id', 'category_name']
+
+# Function that returns the time index columns of the given check-ins: (local time, user row, venue row,
+# VenueCategoryID code, VenueCategoryName code); check-ins without a time are left out
+def timeColumns(data, counts, venues):
+    times = dataset_cache.localTimes(data)
+    keep = np.flatnonzero(times != dataset_cache.NO_TIME)
+    user_rows = pd.Index(counts['user_ids']).get_indexer(np.asarray(data['UserID'])[keep])
+    return (times[keep], user_rows.astype(np.int32),
+            venueRows(venues, np.asarray(data['VenueID'])[keep]).astype(np.int32),
+            counts['id_index'].get_indexer(np.asarray(data['VenueCategoryID'])[keep]).astype(np.int32),
+            counts['name_index'].get_indexer(np.asarray(data['VenueCategoryName'])[keep]).astype(np.int32))
+
+
+# Function that builds the time index from the check-in log
+@metrics.timed()
+def buildTimeIndex(data, counts, venues):
+    return makeTimeIndex(timeColumns(data, counts, venues), len(counts['user_ids']))
+
+
+# Function that sorts time index columns by time and derives the per-user order and the hour-of-week histograms
+def makeTimeIndex(cols, n_users):
+    times, user, venue, category_id, category_name = cols
+    order = np.argsort(times, kind='stable')
+    times, user = times[order], user[order]
+    # per user: the user's check-ins in time order are by_user[user_offsets[u]:user_offsets[u + 1]] (positions in the
+    # sorted columns), and their times user_times[...] (sorted, so a user's window is two binary searches too)
+    by_user = np.argsort(user, kind='stable')
+    hour = hourOfWeek(times)
+
+    return {
+        'times': times,
+        'user': user,
+        'venue': venue[order],
+        'category_id': category_id[order],
+        'category_name': category_name[order],
+        'by_user': by_user,
+        'user_offsets': np.searchsorted(user[by_user], np.arange(n_users + 1)),
+        'user_times': times[by_user],
+        # users x 168 check-in counts per hour of the week (local time, Monday 0:00-1:00 first)
+        'hours': sparse.csr_matrix((np.ones(len(times), dtype=np.int32), (user, hour)), shape=(n_users, 168)),
+        'tail': None,
+    }
+
+
+# Function that returns the parts of a time index read together: the index and the tail of its appended check-ins
+# (users added since a part was made have no rows in it: user_offsets and hours stop before them)
+def timeParts(time_index):
+    return [time_index] if time_index['tail'] is None else [time_index, time_index['tail']]
+
+
+# Function that returns the hour of the week (0 = Monday 0:00-1:00, ..., 167) of local times
+def hourOfWeek(times):
+    # 1970-01-01 was a Thursday (weekday 3)
+    return ((times // 86400 + 3) % 7 * 24 + times // 3600 % 24).astype(np.int32)
+
+
+# Function that returns the time index with the batch's check-ins added
+# the batch is merged into the tail (a small time index of the appended check-ins), and the tail into the index once
+# it outgrows FOLD_SHARE of it: between two merges the index's columns are shared by the snapshots, and an append
+# costs the batch and the tail only
+def updateTimeIndex(time_index, counts, venues, batch):
+    n_users = len(counts['user_ids'])
+    new = timeColumns(batch, counts, venues)
+    order = np.argsort(new[0], kind='stable')
+    new = [column[order] for column in new]
+
+    tail = makeTimeIndex(new, n_users) if time_index['tail'] is None else mergedTimeIndex(time_index['tail'], new, n_users)
+    if len(tail['times']) <= FOLD_SHARE * len(time_index['times']):
+        return dict(time_index, tail=tail)
+    return mergedTimeIndex(time_index, [tail[key] for key in TIME_COLUMNS], n_users)
+
+
+# Function that returns a time index (without tail) with new check-ins' columns (sorted by time) merged in
+# the new check-ins are inserted into the sorted columns at their binary-searched positions, and the per-user order
+# is shifted and merged instead of re-sorted (the rest is copying the current columns)
+def mergedTimeIndex(time_index, new, n_users):
+    # after the check-ins of the same time already indexed (where a stable sort of the whole log puts them)
+    at = np.searchsorted(time_index['times'], new[0], side='right')
+    result = {key: np.insert(time_index[key], at, column) for key, column in zip(TIME_COLUMNS, new)}
+    # the indexed check-ins move up by the number of new ones inserted before them; new check-in i lands at at[i] + i
+    by_user = time_index['by_user'] + np.searchsorted(at, time_index['by_user'], side='right')
+    new_pos = at + np.arange(len(at))
+
+    # each user's positions stay sorted: the new ones are inserted into their user's run (key: user, position)
+    offsets = np.concatenate([time_index['user_offsets'],
+                              np.full(n_users + 1 - len(time_index['user_offsets']), time_index['user_offsets'][-1])])
+    size = len(result['times'])
+    old_keys = np.repeat(np.arange(n_users, dtype=np.int64), np.diff(offsets)) * size + by_user
+    new_keys = new[1].astype(np.int64) * size + new_pos
+    by_key = np.argsort(new_keys, kind='stable')
+    into = np.searchsorted(old_keys, new_keys[by_key])
+    result['by_user'] = np.insert(by_user, into, new_pos[by_key])
+    result['user_times'] = np.insert(time_index['user_times'], into, new[0][by_key])
+    result['user_offsets'] = offsets + np.concatenate([[0], np.cumsum(np.bincount(new[1], minlength=n_users))])
+
+    shape = (n_users, 168)
+    result['hours'] = padded(time_index['hours'], shape) + sparse.csr_matrix(
+        (np.ones(len(new[0]), dtype=np.int32), (new[1], hourOfWeek(new[0]))), shape=shape)
+    result['tail'] = None
+    return result
+
+
+# Function that converts a time window to local times (seconds, see dataset_cache.localTimes): (start, end), end excluded
+# each end is None (open), a number of seconds, or a date/time text in local time ("2012-04-03 18:00")
+def parseWindow(window):
+    if window is None:
+        return None
+
+    def seconds(value):
+        if value is None or value == '':
+            return None
+        if isinstance(value, (int, float, np.integer, np.floating)):
+            return int(value)
+        return int(pd.Timestamp(value).tz_localize(None).to_datetime64().astype('datetime64[s]').astype(np.int64))
+
+    start, end = map(seconds, window)
+    if start is not None and end is not None and start >= end:
+        raise ValueError("the time window must end after it starts")
+    return start, end
+
+
+# Function that returns the positions [lo, hi) of the times of a window in sorted times
+def windowSlice(times, window):
+    start, end = window
+    lo = 0 if start is None else np.searchsorted(times, start, side='left')
+    hi = len(times) if end is None else np.searchsorted(times, end, side='left')
+    return lo, hi
+
+
+# Function that returns one user's counts per VenueCategoryID code in a window as (column indices, counts)
+def windowUserCounts(inputUserID, window):
+    t = tables()
+    pos = t['counts']['user_pos'].get(inputUserID)
+    if pos is None:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+
+    found = [np.empty(0, dtype=np.int32)]
+    for part in timeParts(t['time_index']):
+        if pos + 1 < len(part['user_offsets']):
+            start, end = part['user_offsets'][pos], part['user_offsets'][pos + 1]
+            lo, hi = windowSlice(part['user_times'][start:end], window)
+            found.append(part['category_id'][part['by_user'][start + lo:start + hi]])
+    return np.unique(np.concatenate(found), return_counts=True)
+
+
+# Function that returns a boolean mask over the venue table: True for venues checked into during the window
+def windowVenueMask(window):
+    t = tables()
+    mask = np.zeros(len(t['venues']['table']), dtype=bool)
+    for part in timeParts(t['time_index']):
+        lo, hi = windowSlice(part['times'], window)
+        mask[part['venue'][lo:hi]] = True
+    return mask
+
+
+# Function that returns the L2-normalised user x VenueCategoryName vectors of the check-ins of a window
+# (built from the window's slice only; users without check-ins in it have empty rows)
+@metrics.timed()
+def windowUserVectors(window):
+    t = tables()
+    slices = [(part, *windowSlice(part['times'], window)) for part in timeParts(t['time_index'])]
+    users = np.concatenate([part['user'][lo:hi] for part, lo, hi in slices])
+    names = np.concatenate([part['category_name'][lo:hi] for part, lo, hi in slices])
+    by_name = sparse.csr_matrix((np.ones(len(users), dtype=np.int32), (users, names)), shape=t['counts']['by_name'].shape)
+    return buildUserVectors(by_name)
+
+
+# Function that returns a user's check-ins per hour of the week (168 counts, Monday 0:00-1:00 first, local time)
+def userHourHistogram(inputUserID):
+    t = tables()
+    histogram = np.zeros(168, dtype=np.int64)
+    pos = t['counts']['user_pos'].get(inputUserID)
+    if pos is None:
+        return histogram
+    for part in timeParts(t['time_index']):
+        if pos < part['hours'].shape[0]:
+            histogram += part['hours'][pos].toarray().ravel()
+    return histogram
+
+
+############################## incremental ingestion
+
+# Function that converts new check-ins to a data frame with the log's columns
+# rows: data frame with the 8 columns, list of 8-value rows, or tab separated lines (str) in the format of the dataset file
+def toCheckinFrame(rows):
+    if isinstance(rows, pd.DataFrame):
+        batch = rows
+    elif len(rows) > 0 and isinstance(rows[0], str):
+        text = ''.join(line if line.endswith('\n') else line + '\n' for line in rows)
+        batch = pd.read_csv(io.StringIO(text), sep="\t", names=columns)
+    else:
+        batch = pd.DataFrame(list(rows), columns=columns)
+
+    # the time columns are optional (check-ins without a time are left out of the time index)
+    batch = batch.reindex(columns=columns).dropna(subset=columns[:6])
+    return batch.astype({'UserID': np.int64, 'VenueID': str, 'VenueCategoryID': str, 'VenueCategoryName': str,
+                         'Latitude': np.float64, 'Longitude': np.float64}).reset_index(drop=True)
+
+
+# Function that appends new check-ins to every derived table without reloading the log
+# only what the batch touches is recomputed: the rows of the batch's users, the new venues, and the tail of the time
+# index (merged into it now and then, see updateTimeIndex); the other tables are shared with the current snapshot.
+# the current snapshot is never modified, so readers keep a consistent snapshot while the new one is built and then
+# swapped in: the user x category / venue matrices (and the venue table, when the batch has new venues) are copied,
+# a memory copy that still grows with the dataset (the computation does not)
+# returns the version of the new snapshot
+@metrics.timed()
+def appendCheckins(rows):
+    global snapshot
+
+    batch = toCheckinFrame(rows)
+    with _append_lock:
+        if frozen:
+            raise RuntimeError("the engine is frozen (serving mode): restart the workers to load new check-ins")
+        old = warmup()
+        if len(batch) == 0:
+            return old['version']
+
+        counts = updateCountStore(old['counts'], batch)
+        fingerprint = datasetFingerprint(counts)
+        venues, new_venues = updateVenueTable(old['venues'], counts, batch)
+        # count store rows of the batch's users
+        users = np.unique([counts['user_pos'][uid] for uid in pd.unique(batch['UserID']).tolist()])
+
+        new_names = len(counts['category_names']) > len(old['counts']['category_names'])
+        user_vectors = replacedRows(old['user_vectors'], users, buildUserVectors(counts['by_name'][users]), counts['by_name'].shape)
+        snapshot = {
+            'version': old['version'] + 1,
+            'fingerprint': fingerprint,
+            'counts': counts,
+            'category_index': updateCategoryIndex(old['category_index'], old['counts'], counts),
+            'venues': venues,
+            'venue_index': old['venue_index'].extended(new_venues) if len(new_venues) > 0 else old['venue_index'],
+            'user_vectors': user_vectors,
+            'user_lsh': old['user_lsh'].updated(user_vectors, users) if old['user_lsh'] is not None else None,
+            # neighbour lists change with the counts: answer Task 2 live until refresh_neighbours.py runs again
+            'neighbours': None,
+            # clusters are refit only when a new category appears (otherwise the saved table is kept until the next restart)
+            'category_clusters': loadCategoryClusters(counts, fingerprint) if new_names else old['category_clusters'],
+            'bounds': extendedBounds(old['bounds'], batch['UserID'], new_venues),
+            'time_index': updateTimeIndex(old['time_index'], counts, venues, batch),
+        }
+        return snapshot['version']
+
+
+# Function that returns values not in index, in order of first appearance
+def unseen(index, values):
+    values = pd.unique(np.asarray(values))
+    return values[index.get_indexer(values) < 0]
+
+
+# Function that pads a CSR matrix with empty rows / columns up to shape (the arrays are shared, not copied)
+def padded(matrix, shape):
+    indptr = np.concatenate([matrix.indptr, np.full(shape[0] - matrix.shape[0], matrix.indptr[-1])])
+    return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape)
+
+
+# Function that returns a CSR matrix of the given shape (padded, see padded) with the given rows (sorted, unique)
+# replaced by the rows of block: the entries of the other rows are copied in a few slices, not recomputed
+def replacedRows(matrix, rows, block, shape):
+    matrix = padded(matrix, shape)
+    rows = np.asarray(rows, dtype=np.int64)
+    indptr = matrix.indptr
+    # runs of kept entries: before the first replaced row, between two replaced rows, after the last one
+    run_starts = np.concatenate([[0], indptr[rows + 1]])
+    run_ends = np.concatenate([indptr[rows], [indptr[-1]]])
+
+    data, indices = [matrix.data[run_starts[0]:run_ends[0]]], [matrix.indices[run_starts[0]:run_ends[0]]]
+    for i in range(len(rows)):
+        data += [block.data[block.indptr[i]:block.indptr[i + 1]], matrix.data[run_starts[i + 1]:run_ends[i + 1]]]
+        indices += [block.indices[block.indptr[i]:block.indptr[i + 1]], matrix.indices[run_starts[i + 1]:run_ends[i + 1]]]
+
+    lengths = np.diff(indptr)
+    lengths[rows] = np.diff(block.indptr)
+    return sparse.csr_matrix((np.concatenate(data).astype(matrix.dtype, copy=False), np.concatenate(indices),
+                              np.concatenate([[0], np.cumsum(lengths)])), shape=shape)
+
+
+# Function that returns the rows of a matrix with the batch's entries added, for the rows (sorted, unique) in the batch
+# (block for replacedRows); codes: (row, column) of each entry of the batch
+def addedRows(matrix, rows, codes, values):
+    delta = sparse.csr_matrix((values, (np.searchsorted(rows, codes[0]), codes[1])), shape=(len(rows), matrix.shape[1]))
+    return matrix[rows] + delta
+
+
+# Function that returns a new count store with the batch's check-ins added (new users / categories get new rows / columns)
+# only the rows of the batch's users are recomputed; the user and category lookups are shared when nothing is new
+def updateCountStore(counts, batch):
+    new_users = [uid for uid in pd.unique(batch['UserID']).tolist() if uid not in counts['user_pos']]
+    new_ids = unseen(counts['id_index'], batch['VenueCategoryID'])
+    new_names = unseen(counts['name_index'], batch['VenueCategoryName'])
+
+    store = dict(counts)
+    if new_users:
+        # (widened when a new UserID does not fit the type of the loaded ones, e.g. int16 from the dataset cache)
+        store['user_ids'] = np.concatenate([counts['user_ids'], np.array(new_users, dtype=np.int64)])
+        store['user_pos'] = dict(counts['user_pos'])
+        store['user_pos'].update((uid, len(counts['user_ids']) + i) for i, uid in enumerate(new_users))
+    if len(new_ids) > 0:
+        # VenueCategoryName of each new VenueCategoryID (first occurrence in the batch)
+        first_names = batch.drop_duplicates('VenueCategoryID').set_index('VenueCategoryID')['VenueCategoryName']
+        store['category_ids'] = np.concatenate([counts['category_ids'], new_ids]).astype(object)
+        store['category_id_names'] = np.concatenate([counts['category_id_names'], first_names.reindex(new_ids).to_numpy()]).astype(object)
+        store['id_index'] = counts['id_index'].append(pd.Index(new_ids))
+    if len(new_names) > 0:
+        store['category_names'] = np.concatenate([counts['category_names'], new_names]).astype(object)
+        store['name_index'] = counts['name_index'].append(pd.Index(new_names))
+
+    user_codes = np.array([store['user_pos'][uid] for uid in batch['UserID'].tolist()], dtype=np.int64)
+    rows = np.unique(user_codes)
+    ones = np.ones(len(batch), dtype=np.int32)
+    for key, index, col in [('by_id', store['id_index'], 'VenueCategoryID'), ('by_name', store['name_index'], 'VenueCategoryName')]:
+        shape = (len(store['user_ids']), len(index))
+        column_codes = index.get_indexer(batch[col])
+        matrix = padded(counts[key], shape)
+        store[key] = replacedRows(matrix, rows, addedRows(matrix, rows, (user_codes, column_codes), ones), shape)
+        if key == 'by_name':
+            name_counts = np.bincount(column_codes, minlength=shape[1])
+            name_counts[:len(counts['name_counts'])] += counts['name_counts']
+            store['name_counts'] = name_counts
+
+    store['checkins'] = counts['checkins'] + len(batch)
+    store['checkin_hash'] = (counts['checkin_hash'] + checkinHash(batch)) % 2**64
+    return store
+
+
+# Function that returns (new venue table, new venue rows) with the batch's check-ins added
+# new venues are appended to the table and inserted at the end of their category groups (the table and the groups
+# are copied only when the batch has new venues); only the visited rows of the batch's users are recomputed
+def updateVenueTable(venues, counts, batch):
+    new = ~batch['VenueID'].duplicated().to_numpy() & (venueRows(venues, batch['VenueID']) < 0)
+    new_rows = newVenueRows(batch, new)
+    result = dict(venues)
+
+    if len(new_rows) > 0:
+        start = len(venues['table'])
+        result['table'] = pd.concat([venues['table'], new_rows], ignore_index=True)
+        # the small index of the appended VenueIDs is rebuilt; venue_pos only once they outgrow FOLD_SHARE of it
+        # (a new pandas Index builds its hash table again on its first lookup)
+        added = venues['added_pos'].append(pd.Index(new_rows['VenueID']))
+        if len(added) <= FOLD_SHARE * len(venues['venue_pos']):
+            result['added_pos'] = added
+        else:
+            result['venue_pos'], result['added_pos'] = venues['venue_pos'].append(added), pd.Index([], dtype=object)
+        result['per'] = np.concatenate([venues['per'], new_rows['per'].to_numpy()])
+        rows = np.arange(start, len(result['table']))
+        for key, index, col in [('name', counts['name_index'], 'VenueCategoryName'), ('id', counts['id_index'], 'VenueCategoryID')]:
+            codes = index.get_indexer(new_rows[col])
+            offsets = venues[key + '_offsets']
+            # categories first seen in this batch start with empty groups
+            offsets = np.concatenate([offsets, np.full(len(index) + 1 - len(offsets), offsets[-1])])
+            # (sorted by code: new categories share the same insert position at the end)
+            by_code = np.argsort(codes, kind='stable')
+            result[key + '_order'] = np.insert(venues[key + '_order'], offsets[codes[by_code] + 1], rows[by_code])
+            result[key + '_offsets'] = offsets + np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(index)))])
+
+    shape = (len(counts['user_ids']), len(result['table']))
+    visited = padded(venues['visited'], shape)
+    user_codes = np.array([counts['user_pos'][uid] for uid in batch['UserID'].tolist()], dtype=np.int64)
+    users = np.unique(user_codes)
+    block = addedRows(visited, users, (user_codes, venueRows(result, batch['VenueID'])),
+                      np.ones(len(batch), dtype=bool))
+    result['visited'] = replacedRows(visited, users, block, shape)
+
+    return result, new_rows
 
 
 # 1.
 # goal of the task: recommend 10 unvisited locations to given UID having similar category with given CategoryID
 # @input: random UID, CategoryID
 # @output: VenueID(location) list
-
-def recommendVenueFromIDandCategory(inputUserID, inputCategory):
-    clustered = clusterCategories()
-    corr = getSimilarCategories(inputCategory, clustered)
-    freq_category = getFreqCategory(inputUserID)
-    freq_loc = getFreqLoc(freq_category)
-    h, l = getOutlier(freq_loc['per'])
-
-    # To select places that are not outliers calculated previously, create a standard value 'per' as a latitude/longitude ratio
-    df['per'] = df['Latitude'] / df['Longitude']
-    # Places close to previously found places & places not visited by the entered user ID
-    candidate = df.loc[(l < df['per']) & (h > df['per']) & (df['UserID'] != inputUserID)]
+# window (optional, see parseWindow): only venues checked into during the window are recommended, and the user's
+# frequent categories are counted over the window (over every check-in if the window has too few to tell them)
+
+@metrics.timed()
+def recommendVenueFromIDandCategory(inputUserID, inputCategory, window=None):
+    with pinned():
+        return selectVenues(inputUserID, similarCategoryRows(inputCategory), parseWindow(window))
+
+
+# Function that recommends venues for many (UserID, VenueCategoryName) pairs at once
+# the candidate venues of each category are gathered once for every user asking for it
+@metrics.timed()
+def recommendVenuesBatch(pairs):
+    with pinned():
+        rows = dict()
+        recommends = list()
+        for inputUserID, inputCategory in pairs:
+            if inputCategory not in rows:
+                rows[inputCategory] = similarCategoryRows(inputCategory)
+            recommends.append(selectVenues(inputUserID, rows[inputCategory]))
+        return recommends
+
+
+# Function that returns the venue table rows of the categories similar to inputCategory, most similar category first
+@metrics.timed()
+def similarCategoryRows(inputCategory):
+    t = tables()
+    corr = getSimilarCategories(inputCategory, t['category_clusters'])
 
     # Sorting in the order of places in the category found initially: The reason for sorting rather than selecting is that the selected places have similar conditions, so randomly selecting 10 of them can provide more diverse recommendations to users.
-    i = 0
-    for i in range(len(corr)):
-        if i == 0:
-            recommend = candidate[candidate['VenueCategoryName'] == corr.index[i]]
-        else:
-            recommend = pd.concat([recommend, candidate[candidate['VenueCategoryName'] == corr.index[i]]], axis=0)
+    # (venues of every similar category, category by category, gathered from the venue table)
+    venues = t['venues']
+    return categoryRows(t['counts']['name_index'].get_indexer(corr.index), venues['name_order'], venues['name_offsets'])
+
 
-    # To recommend VenueID(location) list, drop duplicates of VenueID
-    recommend.drop_duplicates('VenueID', inplace=True)
-    recommend = recommend[['VenueID', 'VenueCategoryName', 'Latitude', 'Longitude']]
+# Function that picks 10 venues for inputUserID among the candidate rows (window: local times (start, end), or None)
+@metrics.timed()
+def selectVenues(inputUserID, rows, window=None):
+    venues = tables()['venues']
+    freq_category = getFreqCategory(inputUserID, window)
+    freq_loc = getFreqLoc(freq_category)
+    h, l = getOutlier(freq_loc['per'])
 
-    # it now recommends 10 top places from the df
-    # might be fixed to recommend in various way
-    recommend = recommend.head(10).values.tolist()
-    return recommend
+    with metrics.stage('selectVenues.filter'):
+        # Places close to previously found places ('per' not an outlier) & places never visited by the entered user ID
+        per = venues['per'][rows]
+        rows = rows[(l < per) & (h > per) & ~visitedMask(inputUserID)[rows]]
+        if window is not None:
+            rows = rows[windowVenueMask(window)[rows]]
 
+        # it now recommends 10 top places from the venue table
+        # might be fixed to recommend in various way
+        recommend = venues['table'].iloc[rows[:10]][['VenueID', 'VenueCategoryName', 'Latitude', 'Longitude']]
+        return recommend.values.tolist()
 
-def getFreqCategory(inputUserID):
-    # reframe data from UserID and VenueCategoryID
-    gdf_categoryID = df.groupby(['UserID', 'VenueCategoryID']).size().reset_index()
-    gdf_categoryID.columns = ['UserID', 'VenueCategoryID', 'N']
-    re_user = pd.pivot_table(gdf_categoryID, index='UserID', columns='VenueCategoryID', values='N', fill_value=0)
 
-    # make temporal data frame to count how many times inputUserId visit each places
-    temp = re_user[re_user.index == inputUserID].transpose()
-    # drop places where count = 0
-    temp = temp[temp[inputUserID] != 0]
+@metrics.timed()
+def getFreqCategory(inputUserID, window=None):
+    # read how many times inputUserId visit each places from the precomputed count matrix (only non-zero counts are stored)
+    # (or from the user's check-ins in the window, in the time index)
+    counts = tables()['counts']
+    cols, n = windowUserCounts(inputUserID, window) if window is not None else getUserCounts(inputUserID, 'by_id')
+    temp = pd.DataFrame({inputUserID: n}, index=pd.Index(counts['category_ids'][cols], name='VenueCategoryID'))
 
     # VenueCategoryID -> VenueCategoryName (to show data easily)
-    temp_id = list()
-    for _id in temp.index:
-        temp_id.append(find_category_name_by_id(_id))
-    temp['VenueCategoryName'] = temp_id
+    temp['VenueCategoryName'] = counts['category_id_names'][cols]
 
     # sort by visit frequencies
     temp = temp.sort_values(inputUserID, ascending=False)
@@ -69,18 +898,23 @@ def getFreqCategory(inputUserID):
     m = temp[inputUserID].mean()
     temp = temp[m < temp[inputUserID]]
 
+    # too few check-ins in the window to tell the user's frequent categories: every check-in of the user
+    if len(temp) == 0 and window is not None:
+        return getFreqCategory(inputUserID)
+
     return temp
 
 
 # Function that returns a data frame containing latitude and longitude information of places that inputUserID frequently visits
+@metrics.timed()
 def getFreqLoc(freq_category):
     ## Based on frequency data, extract radius data of places frequented by users from actual latitude and longitude data
 
     # lat, lon info from places that inputUserID frequently visits data (freq.index: Category info of frequently visited places)
-    freq_loc = pd.DataFrame()
-    for _id in freq_category.index:
-        _temp = df[df['VenueCategoryID'] == _id][['Latitude', 'Longitude']]
-        freq_loc = pd.concat([freq_loc, _temp], axis=0)
+    t = tables()
+    venues = t['venues']
+    rows = categoryRows(t['counts']['id_index'].get_indexer(freq_category.index), venues['id_order'], venues['id_offsets'])
+    freq_loc = venues['table'].iloc[rows][['Latitude', 'Longitude']]
 
     # drop duplicates of lat, lon (precise location info) : location info rather than frequency info will be used
     freq_loc = freq_loc.drop_duplicates(['Latitude', 'Longitude'])
@@ -93,6 +927,7 @@ def getFreqLoc(freq_category):
 
 
 # Function that calculate IQR from given data and return its reference value
+@metrics.timed()
 def getOutlier(data):
 
     # Q1 - 1.5 * IQR = lowest, Q3 + 1.5 * IQR = highest (IQR = Q3 - Q1)
@@ -107,6 +942,7 @@ def getOutlier(data):
 
 
 # Function that extracts only data belonging to the same cluster as inputCategory and returns data sorted in a similarity.
+@metrics.timed()
 def getSimilarCategories(inputCategory, similar):
     # Extract frequently visited categories belonging to the same cluster as inputCategory
     # get cluster of inputCategory
@@ -126,26 +962,34 @@ def getSimilarCategories(inputCategory, similar):
     return similar
 
 
-# Function that clusters based on the frequency of visits for each place category and returns numbered data for places with similar visit frequencies
-def clusterCategories():
-    # reframe data by UserID, VenueCategoryName, and the frequency of visiting
-    gdf = df.groupby(['UserID', 'VenueCategoryName']).size().reset_index()
-    gdf.columns = ['UserID', 'VenueCategoryName', 'N']
-    re_category = pd.pivot_table(gdf, index='VenueCategoryName', columns='UserID', values='N', fill_value=0)
+# Function that returns the share (%) of each category in every user's check-ins (VenueCategoryName x UserID), plus their sum
+def categoryShares(counts):
+    # data by VenueCategoryName, UserID, and the frequency of visiting (from the precomputed count matrix)
+    re_category = pd.DataFrame(counts['by_name'].T.toarray(), index=counts['category_names'], columns=counts['user_ids'])
 
     # Value correction: Find the percentage of frequency for each place category.
     corr = re_category.div(re_category.sum(axis=0)).mul(100)
     # to make calculations more convenient later, add up the numbers for each location.
     corr['sum'] = corr.sum(axis=1)
+    return corr
+
+
+# Function that clusters based on the frequency of visits for each place category and returns numbered data for places with similar visit frequencies
+# n_clusters: number of clusters (default: sqrt of (number of categories / 2)); shares: categoryShares(counts) computed
+# beforehand (e.g. to fit several cluster counts on the same data: then only 'sum' and 'cluster' are returned)
+@metrics.timed()
+def clusterCategories(counts, seed=CLUSTERS_SEED, n_clusters=None, shares=None):
+    from sklearn.cluster import KMeans
+    corr = categoryShares(counts) if shares is None else shares[['sum']].copy()
 
     ## cluster by corr['sum'] (= added freq for each location)
 
     # 10% sampling
-    X_sample = corr[['sum']].sample(frac=0.1)
+    X_sample = corr[['sum']].sample(frac=0.1, random_state=seed)
     # n in KMeans = sqrt of (data length/2)
-    n = math.ceil(math.sqrt(corr.shape[0] / 2))
-    # KMeans Clustering
-    kmeans = KMeans(n_clusters=n, init='k-means++')
+    n = n_clusters or defaultClusterCount(len(corr))
+    # KMeans Clustering (fixed seed: the same data always gives the same clusters)
+    kmeans = KMeans(n_clusters=n, init='k-means++', random_state=seed)
     kmeans.fit(X_sample)
     y = kmeans.labels_
     # add cluster number to data
@@ -154,50 +998,199 @@ def clusterCategories():
     return corr
 
 
-# Function that finds VenueCategoryName by venueCategoryID
-def find_category_name_by_id(_id):
-    # drop duplicates of venueCategoryID: to find matching venueCategoryName easily
-    df_unique_categoryID = df.drop_duplicates('VenueCategoryID')
+def defaultClusterCount(n_categories):
+    return math.ceil(math.sqrt(n_categories / 2))
+
 
-    temp_cat = df_unique_categoryID[df_unique_categoryID['VenueCategoryID'] == _id]
-    temp_cat.reset_index(drop=True, inplace=True)
+# Function that returns the cluster table (VenueCategoryName -> sum, cluster) used by getSimilarCategories
+# the table is saved to disk with the dataset fingerprint, and KMeans is refit only when the data (or CLUSTERS_VERSION) changes
+def loadCategoryClusters(counts, fingerprint, path=CLUSTERS_PATH):
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if str(saved['fingerprint']) == fingerprint and int(saved['version']) == CLUSTERS_VERSION:
+                return pd.DataFrame({'sum': saved['sum'], 'cluster': saved['cluster']}, index=saved['category'])
 
-    return temp_cat['VenueCategoryName'][0]
+    clustered = clusterCategories(counts)[['sum', 'cluster']]
+    try:
+        np.savez(path, category=clustered.index.to_numpy(dtype=str), sum=clustered['sum'].to_numpy(),
+                 cluster=clustered['cluster'].to_numpy(), fingerprint=fingerprint, version=CLUSTERS_VERSION)
+    except OSError:
+        # read-only data directory: keep the fitted table in memory only
+        pass
+
+    return clustered
 
 
 # 2.
 # goal of the task: recommend the 10 most similar users with a randomly given user
 # @input param: randomly given UserID
 # @expected output: top 10 UserIds list with the most similar, interests match
+# window (optional, see parseWindow): users are compared on their check-ins during the window only
+# (a user without check-ins in the window is compared on every check-in, as recommend1 does)
+
+def recommendUsersFromID(inputUserID, window=None):
+    return similarUsers([inputUserID], 10, window)[0]
+
+
+# Function that returns the k most similar users for each of the given UserIDs (batch query)
+# users sharing no category with the given one are left out, so a list may hold fewer than k users
+@metrics.timed()
+def similarUsers(inputUserIDs, k=10, window=None):
+    with pinned() as t:
+        positions = np.array([t['counts']['user_pos'][uid] for uid in inputUserIDs], dtype=np.int64)
+
+        # a window: vectors of the window's check-ins, every user scored
+        if window is not None:
+            vectors = windowUserVectors(parseWindow(window))
+            active = np.diff(vectors.indptr)[positions] > 0
+            results = [None] * len(positions)
+            if active.any():
+                ids, _ = topKSimilar(positions[active], k, vectors)
+                for i, row in zip(np.flatnonzero(active), similarLists(ids)):
+                    results[i] = row
+            if not active.all():
+                inactive = np.flatnonzero(~active)
+                for i, row in zip(inactive, similarUsers([inputUserIDs[i] for i in inactive], k)):
+                    results[i] = row
+            return results
+
+        # read from the precomputed neighbour table when it holds enough neighbours
+        neighbours = t['neighbours']
+        if neighbours is not None and k <= neighbours['ids'].shape[1]:
+            return similarLists(neighbours['ids'][positions, :k])
+
+        if t['user_lsh'] is not None:
+            ids, _ = approxTopKSimilar(positions, k)
+        else:
+            ids, _ = topKSimilar(positions, k)
+        return similarLists(ids)
+
 
-def recommendUsersFromID(inputUserID):
-    gdf = df.groupby(['UserID', 'VenueCategoryName']).size().reset_index()
-    gdf.columns = ['UserID', 'VenueCategoryName', 'N']
-    re_category = pd.pivot_table(gdf, index='VenueCategoryName', columns='UserID', values='N', fill_value=0)
-    freq_id = re_category.transpose()
+# Function that returns the UserIDs of topKSimilar rows as lists, without the padding (-1)
+def similarLists(ids):
+    return [[uid for uid in row if uid >= 0] for row in ids.tolist()]
 
+
+# Function that scores the given user rows against every user and keeps the top k (the user itself excluded)
+# returns (UserIDs, cosine similarities), both shaped (len(positions), k) and sorted by similarity
+# users with a similarity of 0 (no category in common) are not kept: rows with fewer are padded with -1 / -inf
+@metrics.timed()
+def topKSimilar(positions, k, user_vectors=None):
     # Cosine similarity: A method of calculating similarity using the angle between vectors; the closer the value is to 1, the more similar it is.
-    # Calculate cosine similarity for each ID and retrieve the cosine similarity vector corresponding to the input userID
-    freq_id['cos'] = cosine_similarity(freq_id)[inputUserID]
+    # user vectors are L2-normalised, so one matrix product gives the cosine similarity to every user
+    t = tables()
+    user_vectors = t['user_vectors'] if user_vectors is None else user_vectors
+    scores = (user_vectors[positions] @ user_vectors.T).toarray()
+    scores[np.arange(len(positions)), positions] = -np.inf
+
+    k = min(k, scores.shape[1] - 1)
+    # select the top k without sorting the whole row, then sort only those k
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    ids = t['counts']['user_ids'][top].astype(np.int64)
+    unrelated = ~(top_scores > 0)
+    ids[unrelated], top_scores[unrelated] = -1, -np.inf
+    return ids, top_scores
+
+
+# Function that finds the top k users like topKSimilar, scoring only the candidates of the LSH index (approximate)
+# users with fewer than k candidates of a similarity above 0 are searched exactly
+@metrics.timed()
+def approxTopKSimilar(positions, k, lsh=None):
+    t = tables()
+    lsh = lsh or t['user_lsh']
+    k = min(k, len(t['counts']['user_ids']) - 1)
+    top, scores = lsh.query(positions, k)
+    top[~(scores > 0)] = -1
+
+    ids = t['counts']['user_ids'][top].astype(np.int64)
+    short = (top < 0).any(axis=1)
+    if short.any():
+        ids[short], scores[short] = topKSimilar(positions[short], k)
+    return ids, scores
+
+
+# Function that builds the LSH index of the user vectors (Task 2 approximate search)
+def buildUserLSH(user_vectors, bits=None, tables=None, probes=None):
+    return HyperplaneLSH(user_vectors, bits or LSH_BITS, tables or LSH_TABLES, LSH_PROBES if probes is None else probes)
+
+
+# Function that L2-normalises each user's VenueCategoryName count vector (rows without check-ins stay empty)
+def buildUserVectors(by_name):
+    vectors = by_name.astype(np.float32)
+    norms = np.sqrt(np.bincount(np.repeat(np.arange(vectors.shape[0]), np.diff(vectors.indptr)),
+                                weights=vectors.data.astype(np.float64) ** 2, minlength=vectors.shape[0]))
+    vectors.data /= np.repeat(np.where(norms > 0, norms, 1), np.diff(vectors.indptr)).astype(np.float32)
+    return vectors
+
+
+# Function that computes the top-n neighbour table of every user (run offline: see refresh_neighbours.py)
+# approximate: search with the LSH index instead of scoring every pair of users (for very many users)
+def buildNeighbourTable(n=NEIGHBOURS_N, chunk=1024, approximate=False):
+    with pinned() as t:
+        n_users = len(t['counts']['user_ids'])
+        lsh = (t['user_lsh'] or buildUserLSH(t['user_vectors'])) if approximate else None
+        ids, scores = [], []
+        for start in range(0, n_users, chunk):
+            positions = np.arange(start, min(start + chunk, n_users))
+            _ids, _scores = approxTopKSimilar(positions, n, lsh) if approximate else topKSimilar(positions, n)
+            ids.append(_ids)
+            scores.append(_scores)
 
-    # Sort the values in descending order, exclude the entered userID, and select the remaining top 10.
-    most_similar = freq_id.sort_values('cos', ascending=False)[1:11].index
+        return {'ids': np.vstack(ids), 'scores': np.vstack(scores).astype(np.float32), 'fingerprint': t['fingerprint']}
 
-    return most_similar.values.tolist()
+
+def saveNeighbourTable(table, path=NEIGHBOURS_PATH):
+    np.savez(path, ids=table['ids'], scores=table['scores'], fingerprint=table['fingerprint'])
+
+
+# Function that loads the neighbour table, or returns None if it is missing or was built from other data
+def loadNeighbourTable(fingerprint, path=NEIGHBOURS_PATH):
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as saved:
+        if str(saved['fingerprint']) != fingerprint:
+            return None
+        return {'ids': saved['ids'], 'scores': saved['scores']}
+
+
+# Function that loads the tables of another city from its registry entry (its own dataset cache and precomputed tables)
+# (every table is built at once, so the memory budget of the shards counts all of them)
+def loadShard(entry):
+    data, _ = dataset_cache.loadDataset(entry['path'], readCheckins)
+    return buildTables(data, entry['neighbours'], entry['clusters']).build()
+
+
+registry = shards.ShardRegistry(REGISTRY, loadShard, int(SHARDS_MB * 2**20))
+
+
+# Function that returns the tables of a city (None = CITY); raises KeyError for a city missing from the registry
+# new check-ins (appendCheckins) go to CITY
+def shardTables(city=None):
+    if city is None or city == CITY:
+        return snapshot or warmup()
+    return registry.get(city)
 
 
 # 3.
 # goal of the task: recommend meeting point with 5 randomly given users and their locations
-# @input param: randomly given 5 UserIDs and their locations (Latitude, Longitude)
+# @input param: randomly given 5 UserIDs (any number in recommendMeetingVenues) and their locations (Latitude, Longitude)
 # @expected output: the location of recommended meeting point
 
 # visualization
 # Function that visually displays the locations of the original userID and suggested locations
 def showMap(inputUserIDs, inputLocs, meetingPoint):
+    import folium
+
     mid = inputLocs.transpose().mean(axis=1)
     m = folium.Map(location=mid, zoom_start=10)
 
-    for i in range(5):
+    for i in range(len(inputUserIDs)):
         folium.Marker(inputLocs[i], tooltip=inputUserIDs[i]).add_to(m)
 
     folium.Marker(meetingPoint,
@@ -207,63 +1200,63 @@ def showMap(inputUserIDs, inputLocs, meetingPoint):
     return m
 
 
-# Function that suggests the optimal meeting location from 5 userIDs and each location
+# Function that suggests the optimal meeting location (lat, lon) from any number of userIDs and their locations:
+# the best venue of recommendMeetingVenues
 def recommendMeetingPointFromIDsandLocs(inputUserIDs, inputLocs):
-    # find mid point from 5 locations
-    mid = inputLocs.transpose().mean(axis=1)
-
-    # find VenueCategoryNames that suit each userID's tastes
-    freq_categories = pd.DataFrame(columns=inputUserIDs)
-    for i in range(5):
-        temp = getFreqCategory(inputUserIDs[i])['VenueCategoryName']
-        freq_categories = pd.concat([freq_categories, temp], axis=1)
-
-    ## Select one category with the most overlap between categories
-    temp_list = list(freq_categories)
-    temp_set = list(set(temp))
-    max = 0
-    most_freq_category = temp_set[0]
-    # find overlapping categories and their number, and find the category with the most overlap.
-    for i in range(len(temp_set)):
-        cnt = temp_list.count(temp_set[i])
-        if cnt > max:
-            max = cnt
-            most_freq_category = temp_set[i]
-
-    if max == 1:
-        # If NO overlapping categories -> just recommend the closest location from mid.
-        data = np.array(df[['Latitude', 'Longitude']])
-    else:
-        # If overlapping categories (O) -> recommend appropriate location by the most overlapping categories and mid location info
-        data = np.array(df[df['VenueCategoryName'] == most_freq_category][['Latitude', 'Longitude']])
-
-    meetingPoint = findNearestLoc(mid, data)
-
-    return meetingPoint
-
-
-# Function that finds the closest x,y to a random x,y among the x,y in the given data
-def findNearestLoc(point, data):
-
-    mn = 10000
-    idx = 0
-
-    for i in range(len(data)):
-
-        # Euclidean distance
-        s = np.sum((point - data[i]) ** 2)
-
-        if s < mn:
-            mn = s
-            idx = i
-
-    return data[i]
+    best = recommendMeetingVenues(inputUserIDs, inputLocs, 1)[0]
+    return np.array(best[2:4])
+
+
+# Function that recommends the k best meeting venues for the users and their locations, best first:
+# [VenueID, VenueCategoryName, Latitude, Longitude, travel (km), number of users often visiting the category]
+# the venues around the centre of the locations are scored in one pass: users who often visit the venue's category
+# (count above their mean, as in getFreqCategory) minus the travel beyond the shortest one (MEETING_KM_PER_USER per user)
+@metrics.timed()
+def recommendMeetingVenues(inputUserIDs, inputLocs, k=10, center=None):
+    # one snapshot of the tables for the whole computation
+    with pinned() as t:
+        locs = np.asarray(inputLocs, dtype=np.float64).reshape(-1, 2)
+        center = center or MEETING_CENTER
+        if center == 'minimax':
+            mid = minimaxPoint(locs)
+        elif center == 'median':
+            mid = geometricMedian(locs)
+        else:
+            mid = locs.mean(axis=0)
+
+        # candidate venues: the closest ones to the centre
+        venue_index = t['venue_index']
+        rows, _ = venue_index.nearest(mid, MEETING_CANDIDATES, None, 'haversine')
+        travel = distanceMatrixKm(locs, venue_index.coords[rows])
+        travel = travel.max(axis=0) if center == 'minimax' else travel.mean(axis=0)
+
+        # users x categories: which categories each user visits more often than their mean (one row of the count store each)
+        counts = t['counts']
+        positions = [counts['user_pos'][uid] for uid in inputUserIDs if uid in counts['user_pos']]
+        by_name = counts['by_name'][positions]
+        n = np.diff(by_name.indptr)
+        means = np.asarray(by_name.sum(axis=1)).ravel() / np.maximum(n, 1)
+        frequent = by_name.data > np.repeat(means, n)
+        # number of users often visiting each category
+        overlap = np.bincount(by_name.indices[frequent], minlength=by_name.shape[1])
+
+        codes = counts['name_index'].get_indexer(venue_index.venues['VenueCategoryName'].to_numpy()[rows])
+        users = np.where(codes >= 0, overlap[np.maximum(codes, 0)], 0)
+        score = users - (travel - travel.min()) / MEETING_KM_PER_USER
+
+        k = min(k, len(rows))
+        best = np.argpartition(-score, k - 1)[:k]
+        best = best[np.lexsort((travel[best], -score[best]))]
+
+        venues = venue_index.venues.iloc[rows[best]]
+        return [[venue_id, name, float(lat), float(lon), float(km), int(n)] for venue_id, name, lat, lon, km, n
+                in zip(venues['VenueID'], venues['VenueCategoryName'], venues['Latitude'], venues['Longitude'],
+                       travel[best], users[best])]
 
 
 # Function that gets a UserID from the user
 def getUserID():
-    # 수정 1083
-    while ((inputUserID := int(input("Enter UserID (from 1 to 1083): "))) < 1 or inputUserID > 1083):
+    while not checkUserID(inputUserID := int(input("Enter UserID (from " + userRange() + "): "))):
         print("UserID Error")
         continue
 
@@ -272,29 +1265,16 @@ def getUserID():
 
 # Function that gets a VenueCategoryName from the user
 def getCategoryName():
-    cnt = 0
-    CategoryType = df['VenueCategoryName'].value_counts().index
-
     # Repeat until the data frame contains a CategoryName that contains the characters entered by the user
-    while cnt >= 0:
+    while True:
 
         inputCategory = input("Enter VenueCategoryName: ")
 
-        if inputCategory.strip() == "":
-            pass
-
         # If a CategoryName contains characters entered by the user, return the exact CategoryName
-        for _type in CategoryType:
-            if inputCategory.strip() in _type:
-                inputCategory = _type
-                cnt = -1
-                break
-
-        if cnt >= 0:
-            print("CategoryName Error")
-            cnt += 1
+        if (inputCategory := checkCategory(inputCategory)) is not False:
+            return inputCategory
 
-    return inputCategory
+        print("CategoryName Error")
 
 
 # Function that gets 5 UserIDs from the user
@@ -303,7 +1283,7 @@ def get_5_UserIDs():
 
     while inputCheck == False:
 
-        temp = input("Enter 5 UserID(from 1 to 1083)s: ").split()
+        temp = input("Enter 5 UserID(from " + userRange() + ")s: ").split()
         for i in range(len(temp)):
             temp[i] = temp[i].rstrip(r',$')
         inputUserIDs = list(map(int, temp))
@@ -314,8 +1294,8 @@ def get_5_UserIDs():
 
         i = 0
         for n in inputUserIDs:
-            if n < 1 or n > 1083:
-                print("UserID Error (" + n + " could not be accepted)")
+            if not checkUserID(n):
+                print("UserID Error (" + str(n) + " could not be accepted)")
                 i += 1
 
         if i < 1:
@@ -347,6 +1327,8 @@ def get_5_Locations(inputUserIDs):
                 print("Latitude Range Error (it must be in range of (-90, 90))")
             elif abs(lon) > 180:
                 print("Longitude Range Error (it must be in range of (-180, 180))")
+            elif not checkLocation(lat, lon):
+                print("Location Error (outside the area of the dataset)")
             else:
                 break
 
@@ -408,60 +1390,180 @@ def recommend_3():
 #################################### functions to use in app.py
 ### functions to operate when parameters are given
 
+# results of the functions below, keyed by the dataset fingerprint (a new dataset or appended check-ins never hit old entries)
+# the result store is read and written only for the dataset as loaded (version 0): after check-ins are appended,
+# results are computed on the new data (and kept in memory only, so the store never fills with one set per append)
+results_cache = ResultCache(int(RESULT_CACHE_MB * 2**20), RESULT_CACHE_TTL)
+# optional on-disk result store (result_store.ResultStore) read after the in-memory cache, e.g. filled by batch_recommend.py
+result_store = None
+
+
+# Function that returns the key of a result: "1|uid|category[|start-end]", "2|uid[|start-end]",
+# "3|uid,uid,...|lat,lon;lat,lon;...[|k]" (start-end: a time window in local times, see parseWindow)
+def resultKey(task, *args):
+    if task == 3:
+        inputUserIDs, inputLocs, *k = args
+        return ("3|" + ",".join(map(str, inputUserIDs)) + "|" + ";".join("%.6f,%.6f" % (lat, lon) for lat, lon in inputLocs)
+                + "".join("|" + str(v) for v in k))
+    return "|".join(str(v) if not isinstance(v, (tuple, list)) else "%s-%s" % parseWindow(v) for v in (task,) + args)
+
+
+# Function that returns a cached result (in-memory cache, then result store) or computes it
+def cachedResult(key, compute):
+    return cachedResults([key], lambda positions: [compute()])[0]
+
+
+# Function that returns the results of many keys: cached ones are read, the others computed together
+# compute(positions) returns the results of keys[positions] (one batch call)
+# computed results are added to the result store by its background writer (not on the caller's time)
+def cachedResults(keys, compute):
+    with pinned() as t:
+        fingerprint = t['fingerprint']
+        store = result_store if t['version'] == 0 else None
+        results = [results_cache.get((fingerprint, key)) for key in keys]
+        if store is not None:
+            for i, key in enumerate(keys):
+                if results[i] is None and (stored := store.get(fingerprint, key)) is not None:
+                    results[i] = stored
+                    results_cache.put((fingerprint, key), stored)
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            computed = compute(missing)
+            for i, result in zip(missing, computed):
+                results[i] = result
+                results_cache.put((fingerprint, keys[i]), result)
+            if store is not None:
+                store.putLater(fingerprint, [(keys[i], results[i]) for i in missing])
+
+        return results
+
+
 # Task1
 # recommend 10 unvisited locations to given UID having similar category with given CategoryID
-def recommend_1_with_param(inputUserID, inputCategory):
-    recommendedVenueIDs = recommendVenueFromIDandCategory(inputUserID, inputCategory)
-    print(recommendedVenueIDs)
+def recommend_1_with_param(inputUserID, inputCategory, window=None):
+    key = resultKey(1, inputUserID, inputCategory, *([window] if window is not None else []))
+    recommendedVenueIDs = cachedResult(key, lambda: recommendVenueFromIDandCategory(inputUserID, inputCategory, window))
     return recommendedVenueIDs
 
 # Task2
 # recommend the 10 most similar users with a randomly given user
-def recommend_2_with_param(inputUserID):
-    recommendedUserIDs = recommendUsersFromID(inputUserID)
-    print(recommendedUserIDs)
+def recommend_2_with_param(inputUserID, window=None):
+    key = resultKey(2, inputUserID, *([window] if window is not None else []))
+    recommendedUserIDs = cachedResult(key, lambda: recommendUsersFromID(inputUserID, window))
     return recommendedUserIDs
 
 # Task3
 # recommend meeting point with 5 randomly given users and their locations
+# returns (meeting point, map_id): the map is kept in memory under map_id (see meetingMapHTML / meetingMapGeoJSON)
+# and recorded in the result store, so every worker process of serve.py can show it
 def recommend_3_with_param(inputUserIDs, inputLocs):
     inputLocs = np.array(inputLocs)
-    meetingPoint = recommendMeetingPointFromIDsandLocs(inputUserIDs, inputLocs)
-    m = showMap(inputUserIDs, inputLocs, meetingPoint)
+    meetingPoint = cachedResult(resultKey(3, inputUserIDs, inputLocs.tolist()),
+                                lambda: recommendMeetingPointFromIDsandLocs(inputUserIDs, inputLocs).tolist())
+
+    map_id = uuid.uuid4().hex
+    entry = {'uids': [int(uid) for uid in inputUserIDs], 'locs': inputLocs.tolist(), 'point': [float(v) for v in meetingPoint]}
+    maps_cache.put(map_id, entry)
+    if result_store is not None:
+        result_store.putMap(map_id, entry, RESULT_CACHE_TTL)
+
+    return list(meetingPoint), map_id
+
+
+# maps of Task 3 by map_id (one per request, so concurrent users never overwrite each other's map)
+maps_cache = ResultCache(int(MAP_CACHE_MB * 2**20), RESULT_CACHE_TTL)
+
+
+# Function that returns the map of a Task 3 request: from this process's cache, or recorded by another worker
+# in the result store (None if map_id is unknown or expired)
+def meetingMapEntry(map_id):
+    entry = maps_cache.get(map_id)
+    if entry is None and result_store is not None and (entry := result_store.getMap(map_id, RESULT_CACHE_TTL)) is not None:
+        maps_cache.put(map_id, entry)
+    return entry
+
+
+# Function that returns the folium map of a Task 3 request as HTML (None if map_id is unknown or expired)
+# the map is rendered in memory on the first view and kept for the next ones
+def meetingMapHTML(map_id):
+    entry = meetingMapEntry(map_id)
+    if entry is None:
+        return None
 
-    m.save('templates/r3_out_map.html')
+    if 'html' not in entry:
+        m = showMap(entry['uids'], np.array(entry['locs']), entry['point'])
+        entry = dict(entry, html=m.get_root().render())
+        maps_cache.put(map_id, entry)
 
-    # # save img
-    # options = webdriver.ChromeOptions()
-    # options.add_argument('--headless')
-    # # options.add_experimental_option("detach", True)
-    # service = Service(executable_path=r"C:/chromedriver/chromedriver.exe")
-    # driver = webdriver.Chrome(service=service, options=options)
-    #
-    # img_data = m._to_png(5, driver=driver)
-    # img = Image.open(io.BytesIO(img_data))
-    # img.save('r3_out_map.png')
+        # # save img
+        # options = webdriver.ChromeOptions()
+        # options.add_argument('--headless')
+        # # options.add_experimental_option("detach", True)
+        # service = Service(executable_path=r"C:/chromedriver/chromedriver.exe")
+        # driver = webdriver.Chrome(service=service, options=options)
+        #
+        # img_data = m._to_png(5, driver=driver)
+        # img = Image.open(io.BytesIO(img_data))
+        # img.save('r3_out_map.png')
 
-    return meetingPoint.tolist()
+    return entry['html']
+
+
+# Function that returns the map of a Task 3 request as GeoJSON (None if map_id is unknown or expired)
+def meetingMapGeoJSON(map_id):
+    entry = meetingMapEntry(map_id)
+    if entry is None:
+        return None
+    return meetingGeoJSON(entry['uids'], entry['locs'], entry['point'])
+
+
+# Function that returns the users' locations and the meeting point as a GeoJSON FeatureCollection (drawn by the browser)
+def meetingGeoJSON(inputUserIDs, inputLocs, meetingPoint):
+    features = list()
+    for uid, (lat, lon) in zip(inputUserIDs, inputLocs):
+        features.append({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+                         'properties': {'role': 'user', 'UserID': int(uid)}})
+
+    lat, lon = meetingPoint
+    features.append({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+                     'properties': {'role': 'meetingPoint'}})
+
+    return {'type': 'FeatureCollection', 'features': features}
 
 def checkUserID(inputUserID):
 
-    # inputUserID range : 1 ~ 1083
-    if inputUserID < 1 or inputUserID > 1083:
-        return False
+    # the UserID must be one of the users of the loaded dataset (city)
+    # (before its tables are loaded, the users of the default city are read from its dataset cache)
+    if tablesPending():
+        users = datasetUserIDs()
+        position = np.searchsorted(users, inputUserID)
+        return bool(position < len(users) and users[position] == inputUserID)
+    return inputUserID in tables()['counts']['user_pos']
+
+# Function that returns the UserID range of the dataset as text (e.g. "1 to 1083")
+def userRange():
+    if tablesPending():
+        users = datasetUserIDs()
+        low, high = int(users[0]), int(users[-1])
     else:
-        return True
+        low, high = tables()['bounds']['users']
+    return str(low) + " to " + str(high)
 
-def checkCategory(inputCategory):
+# Function that checks that a location is in the area of the dataset (the box of its venues, with a margin)
+def checkLocation(lat, lon):
+    bounds = tables()['bounds']
+    return (bounds['latitude'][0] - LOCATION_MARGIN <= lat <= bounds['latitude'][1] + LOCATION_MARGIN
+            and bounds['longitude'][0] - LOCATION_MARGIN <= lon <= bounds['longitude'][1] + LOCATION_MARGIN)
 
-    # every category type given
-    CategoryType = df['VenueCategoryName'].value_counts().index
+def checkCategory(inputCategory):
 
-    # If a CategoryName contains characters entered by the user, return the exact CategoryName
-    for _type in CategoryType:
-        if inputCategory.strip() in _type:
-            inputCategory = _type
-            return inputCategory
+    # If a CategoryName contains characters entered by the user, return the exact CategoryName (the most frequent one)
+    if (name := tables()['category_index'].match(inputCategory.strip())) is not None:
+        return name
 
     # If there is no matching category, return false
     return False
+
+
+_startup['import_s'] = time.perf_counter() - _import_start
@@ -0,0 +1,92 @@
+import numpy as np
+
+# Approximate cosine nearest neighbours over the L2-normalised user vectors (Task 2 on very many users)
+# random-hyperplane LSH (SimHash): each table hashes a vector to the signs of its dot products with `bits` random
+# hyperplanes; users sharing a hash in any table (or, with probes=1, a hash one bit away) are the candidates,
+# which are then scored exactly. more tables / probes: better recall, more candidates; more bits: fewer candidates.
+
+
+class HyperplaneLSH:
+
+    def __init__(self, vectors, bits=16, tables=8, probes=1, seed=0, chunk=65536):
+        # vectors: users x categories CSR matrix, rows L2-normalised
+        self.vectors = vectors
+        self.bits = bits
+        self.probes = probes
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((vectors.shape[1], bits * tables)).astype(np.float32)
+
+        # per table: hashes sorted, and the user rows in that order (one bucket = one run of equal hashes)
+        n = vectors.shape[0]
+        # (tables x users, one contiguous row per table)
+        hashes = np.vstack([self.hash(np.arange(start, min(start + chunk, n))) for start in range(0, n, chunk)]).T.copy()
+        self.order = np.argsort(hashes, axis=1, kind='stable')
+        self.sorted = np.take_along_axis(hashes, self.order, axis=1)
+
+    # Function that returns an index over new vectors in which only the given rows changed (rows past the current
+    # ones are new users, columns past the current ones new categories): their hashes are recomputed and moved to
+    # their buckets, the other hashes are kept (they have no counts in new columns, so new hyperplane rows leave them as they are)
+    def updated(self, vectors, rows):
+        index = HyperplaneLSH.__new__(HyperplaneLSH)
+        index.vectors, index.bits, index.probes, index.seed = vectors, self.bits, self.probes, self.seed
+        index.planes = self.planes
+        if vectors.shape[1] > len(self.planes):
+            rng = np.random.default_rng((self.seed, vectors.shape[1]))
+            extra = rng.standard_normal((vectors.shape[1] - len(self.planes), self.planes.shape[1])).astype(np.float32)
+            index.planes = np.vstack([self.planes, extra])
+        rows = np.asarray(rows, dtype=np.int64)
+        hashes = index.hash(rows).T
+
+        keep = ~np.isin(self.order, rows)
+        order = self.order[keep].reshape(len(self.order), -1)
+        hashed = self.sorted[keep].reshape(len(self.sorted), -1)
+        new_order, new_sorted = [], []
+        for table in range(len(order)):
+            by_hash = np.argsort(hashes[table], kind='stable')
+            at = np.searchsorted(hashed[table], hashes[table][by_hash], side='right')
+            new_order.append(np.insert(order[table], at, rows[by_hash]))
+            new_sorted.append(np.insert(hashed[table], at, hashes[table][by_hash]))
+        index.order, index.sorted = np.vstack(new_order), np.vstack(new_sorted)
+        return index
+
+    # Function that returns the hash of the given rows in every table, shaped (len(rows), tables)
+    def hash(self, rows):
+        signs = np.asarray(self.vectors[rows] @ self.planes) > 0
+        signs = signs.reshape(len(rows), -1, self.bits)
+        return signs @ (np.int64(1) << np.arange(self.bits, dtype=np.int64))
+
+    # Function that returns the candidate rows of one user from its hashes h (every row sharing a probed bucket)
+    def candidates(self, h):
+        # probes=1: also the buckets whose hash differs by one bit
+        flips = np.array([0] + ([1 << b for b in range(self.bits)] if self.probes else []), dtype=np.int64)
+        found = []
+        for table in range(len(self.sorted)):
+            keys = h[table] ^ flips
+            starts = np.searchsorted(self.sorted[table], keys, side='left')
+            ends = np.searchsorted(self.sorted[table], keys, side='right')
+            found += [self.order[table, s:e] for s, e in zip(starts, ends) if e > s]
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+    # Function that returns the approximate top k rows and cosine similarities of the given rows (the row itself excluded)
+    # sorted by similarity; rows with fewer than k candidates are padded with -1 / -inf
+    def query(self, rows, k):
+        rows = np.asarray(rows, dtype=np.int64)
+        top = np.full((len(rows), k), -1, dtype=np.int64)
+        top_scores = np.full((len(rows), k), -np.inf)
+
+        for i, (row, h) in enumerate(zip(rows, self.hash(rows))):
+            found = self.candidates(h)
+            found = found[found != row]
+            if len(found) == 0:
+                continue
+
+            # candidates are scored exactly
+            scores = (self.vectors[found] @ self.vectors[row].T).toarray().ravel()
+            n = min(k, len(found))
+            best = np.argpartition(-scores, n - 1)[:n]
+            best = best[np.argsort(-scores[best], kind='stable')]
+            top[i, :n] = found[best]
+            top_scores[i, :n] = scores[best]
+
+        return top, top_scores
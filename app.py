@@ -1,6 +1,20 @@
+import os
+import io
+import json
+import time
+import cProfile
+import pstats
+import secrets
+import threading
 import pandas as pd
-from flask import Flask, request, render_template, redirect, flash
+from functools import wraps
+from flask import Flask, request, render_template, redirect, flash, jsonify, abort, Response, stream_with_context, g, url_for
 import KDSP_Task3_V1 as kdsp
+import ingest
+import jobs
+import metrics
+import queries
+from result_store import ResultStore, RESULTS_PATH
 
 from flask_wtf import FlaskForm
 from wtforms import IntegerField, FloatField, FieldList, FormField
@@ -15,31 +29,178 @@ class MainForm(FlaskForm):
     forms = FieldList(FormField(AForm), min_entries=5, max_entries=5)
 
 app = Flask(__name__)
-app.secret_key = "super secret key"
+# signs the session cookie (flash messages). Without KDSP_SECRET_KEY a random key is made at start:
+# sessions do not survive a restart, and serve.py makes it before forking so every worker shares it
+app.secret_key = os.environ.get('KDSP_SECRET_KEY') or secrets.token_hex(32)
+
+# loading of the data and of every table (see kdsp.warmup), KDSP_WARMUP:
+#   background (default): on a thread once the app is created, so the server answers at once (/healthz) and
+#     reports ready (/readyz) when the tables are built; a request needing them earlier builds what it needs
+#   eager: before the app is created (the import waits for it); off: each table on its first use only
+# (serve.py loads everything before forking the workers in any case)
+WARMUP = os.environ.get('KDSP_WARMUP', 'background')
+warmup_error = None
+
+def warm():
+    global warmup_error
+    try:
+        kdsp.warmup(full=True)
+    except Exception as e:
+        warmup_error = repr(e)
+        raise
+
+if WARMUP == 'eager':
+    warm()
+
+# optional: follow a check-in file and add its new rows without a restart (e.g. KDSP_FOLLOW=Project3_Data/dataset_NYC.txt)
+if os.environ.get('KDSP_FOLLOW'):
+    ingest.startFollowing(os.environ['KDSP_FOLLOW'])
+
+# precomputed results (see batch_recommend.py); results missing from the store are computed and added (read-through)
+kdsp.result_store = ResultStore(os.environ.get('KDSP_RESULTS', RESULTS_PATH))
+
+# per-request profiling: with KDSP_PROFILE=1, adding ?profile=1 to any request returns its cProfile report instead
+# of the response (&sort=cumulative|tottime|calls, &limit=40)
+PROFILING = os.environ.get('KDSP_PROFILE') == '1'
+
+@app.before_request
+def start_request():
+    g.start = time.perf_counter()
+    g.profiler = None
+    if PROFILING and request.args.get('profile'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def end_request(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.request_seconds.observe(time.perf_counter() - g.start, (endpoint,))
+    metrics.requests_total.inc((endpoint, request.method, str(response.status_code)))
+
+    if g.get('profiler') is not None:
+        # streamed responses are generated here, so their work is in the profile too
+        response.get_data()
+        g.profiler.disable()
+        report = io.StringIO()
+        stats = pstats.Stats(g.profiler, stream=report).sort_stats(request.args.get('sort', 'cumulative'))
+        stats.print_stats(request.args.get('limit', 40, type=int))
+        return Response(report.getvalue(), mimetype='text/plain')
+    return response
+
+# liveness: the process answers (cheap, never loads the data)
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+# readiness: 200 once the data and every table of the default city are loaded (see KDSP_WARMUP), 503 before
+# (or when the warmup failed), with the startup time breakdown so far
+@app.route('/readyz')
+def readyz():
+    ready = kdsp.ready()
+    body = {'ready': ready, 'startup': kdsp.startupReport()}
+    if warmup_error is not None:
+        body['error'] = warmup_error
+    return jsonify(body), 200 if ready else 503
+
+@app.route('/metrics')
+def metrics_page():
+    # Prometheus text format: stage and request latency histograms, request counts, cache statistics
+    text = metrics.render({'results': kdsp.results_cache, 'maps': kdsp.maps_cache})
+    text += '\n'.join(metrics.gaugeLines('kdsp_shard_bytes', "Estimated memory of the loaded city shards", 'city',
+                                         kdsp.registry.loaded())) + '\n'
+    stats = job_queue.stats()
+    text += '\n'.join(metrics.counterLines('kdsp_jobs_total', "Asynchronous jobs by outcome of their submission", 'outcome',
+                                           {key: stats[key] for key in ['submitted', 'coalesced', 'rejected', 'failed']})
+                       + metrics.gaugeLines('kdsp_jobs', "Asynchronous jobs held by state", 'state',
+                                            {key: stats[key] for key in ['pending', 'running', 'done', 'failed']})) + '\n'
+    startup = kdsp.startupReport()
+    stages = dict({'import': startup['import_s'], 'dataset': startup['dataset_s']},
+                  **{'table.' + key: seconds for key, seconds in startup['tables_s'].items()})
+    text += '\n'.join(metrics.gaugeLines('kdsp_startup_seconds', "Time spent starting the engine by stage", 'stage',
+                                         {key: seconds for key, seconds in stages.items() if seconds is not None})) + '\n'
+    if kdsp.frozen:
+        # pre-forked workers (serve.py): every worker counts on its own, so each sample is labelled with the worker
+        # that answered the scrape (sum over the worker label for totals)
+        text = metrics.addLabels(text, ('worker',), (str(os.getpid()),))
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+# every city is its own dataset (see shards.py): pages and APIs take ?city=<city> (or a form field city),
+# default kdsp.CITY. by_city runs the view on the tables of that city
+def by_city(view):
+    @wraps(view)
+    def routed(*args, **kwargs):
+        g.city = request.values.get('city') or kdsp.CITY
+        # the default city is pinned on its first use: a request rejected before it needs the tables
+        # (e.g. an unknown UserID) is answered without loading them
+        shard = None
+        if g.city != kdsp.CITY:
+            try:
+                shard = kdsp.shardTables(g.city)
+            except KeyError:
+                abort(404, 'unknown city ' + g.city)
+            except OSError:
+                abort(503, 'the dataset of ' + g.city + ' is not available')
+        try:
+            with kdsp.pinned(shard, lazy=True):
+                return view(*args, **kwargs)
+        except OSError:
+            if kdsp.snapshot is not None:
+                raise
+            abort(503, 'the dataset of ' + g.city + ' is not available')
+    return routed
+
+def user_error():
+    return 'UserID should be one of the users of ' + kdsp.registry.cities().get(g.city, g.city) + ' (' + kdsp.userRange() + ')'
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', cities=kdsp.registry.cities())
 
 @app.route('/recommend1')
+@by_city
 def recommend1():
-    return render_template('recommend1.html')
+    return render_template('recommend1.html', city=g.city, users=kdsp.userRange())
 
 @app.route('/recommend2')
+@by_city
 def recommend2():
-    return render_template('recommend2.html')
+    return render_template('recommend2.html', city=g.city, users=kdsp.userRange())
 
 @app.route('/recommend3')
+@by_city
 def recommend3():
     form = MainForm()
-    return render_template('recommend3.html', form=form)
+    return render_template('recommend3.html', form=form, city=g.city)
+
+@app.route('/autocomplete')
+@by_city
+def autocomplete():
+    # suggest category names containing the typed text (?q=...&limit=10)
+    text = request.args.get('q', '')
+    limit = request.args.get('limit', 10, type=int)
+    return jsonify(kdsp.tables()['category_index'].complete(text, limit))
 
-@app.route('/map')
-def map():
-    return render_template('r3_out_map.html')
+# maps of /method3 results, kept per request (map_id) in memory and in the result store (shared by the workers)
+@app.route('/map/<map_id>')
+def map(map_id):
+    if (html := kdsp.meetingMapHTML(map_id)) is None:
+        abort(404)
+    return html
+
+@app.route('/map/<map_id>.geojson')
+def map_geojson(map_id):
+    if (geojson := kdsp.meetingMapGeoJSON(map_id)) is None:
+        abort(404)
+    return jsonify(geojson)
+
+@app.route('/map/<map_id>/lite')
+def map_lite(map_id):
+    # the browser draws the GeoJSON with leaflet (no folium on the server)
+    return render_template('r3_map_lite.html', map_id=map_id)
 
 
 @app.route('/method1', methods=['GET', 'POST'])
+@by_city
 def method1():
     if request.method == 'POST':
 
@@ -50,18 +211,19 @@ def method1():
 
         # if the input does not meet the criteria, redirect back to recommend1.html
         if kdsp.checkUserID(inputUserID) is False:
-            flash('UserID should be in 1 to 1083', 'error')
-            return redirect('recommend1')
+            flash(user_error(), 'error')
+            return redirect(url_for('recommend1', city=g.city))
 
         if (inputCategory := kdsp.checkCategory(inputCategory)) is False:
             flash('Enter a correct category name', 'error')
-            return redirect('recommend1')
+            return redirect(url_for('recommend1', city=g.city))
 
         # implement recommendation function
         recommended = kdsp.recommend_1_with_param(inputUserID, inputCategory)
         return render_template('recommend1_out.html', recommended = recommended)
 
 @app.route('/method2', methods=['POST'])
+@by_city
 def method2():
 
     # set default uid ( = 1)
@@ -72,8 +234,8 @@ def method2():
 
     # if the input does not meet the criteria, redirect back to recommend2.html
     if kdsp.checkUserID(inputUserID) is False:
-        flash('UserID should be in 1 to 1083', 'error')
-        return redirect('recommend2')
+        flash(user_error(), 'error')
+        return redirect(url_for('recommend2', city=g.city))
 
     # implement recommendation function
     recommended = kdsp.recommend_2_with_param(inputUserID)
@@ -82,6 +244,7 @@ def method2():
 
 
 @app.route('/method3', methods=['POST'])
+@by_city
 def method3():
 
     # get values from form fields
@@ -102,25 +265,176 @@ def method3():
     # if the input does not meet the criteria, redirect back to recommend3.html
     for id in inputUserIDs:
         if kdsp.checkUserID(id) is False:
-            flash('UserID should be in 1 to 1083', 'error')
-            return redirect('recommend3')
+            flash(user_error(), 'error')
+            return redirect(url_for('recommend3', city=g.city))
 
     for i in range(5):
-        if abs(lats[i])<=90 and abs(lons[i])<=180:
+        if kdsp.checkLocation(lats[i], lons[i]):
             data.append([lats[i], lons[i]])
-        elif abs(lats[i]) > 90:
-            flash('Latitude should be in -90 to 90', 'error')
-            return redirect('recommend3')
         else:
-            flash('Longitude should be in -180 to 180', 'error')
-            return redirect('recommend3')
+            flash('Location ' + str([lats[i], lons[i]]) + ' is outside ' + kdsp.registry.cities().get(g.city, g.city), 'error')
+            return redirect(url_for('recommend3', city=g.city))
 
     # implement recommendation function
     inputLocs = pd.DataFrame(data, columns=['Latitude', 'Longitude'])
-    recommended = kdsp.recommend_3_with_param(inputUserIDs, inputLocs)
+    recommended, map_id = kdsp.recommend_3_with_param(inputUserIDs, inputLocs)
+
+    # API callers (?format=geojson) get the users and the meeting point as GeoJSON instead of the page
+    if request.args.get('format', request.form.get('format')) == 'geojson':
+        geojson = kdsp.meetingGeoJSON(inputUserIDs, data, recommended)
+        geojson['map_id'] = map_id
+        return jsonify(geojson)
+
+    return render_template('recommend3_out.html', recommended = recommended, map_id = map_id)
+
+
+############################## batch JSON API
+# POST a JSON array of queries (or {"queries": [...]}) to /api/v1/recommend1, 2 or 3:
+#   recommend1: [{"uid": 5, "category": "Bar"}, ...]
+#   recommend2: [{"uid": 5}, ...] or {"uids": [5, 6, ...]}
+#   recommend3: [{"uids": [1, 2, 3], "locs": [[40.7, -74.0], [40.8, -73.9], [40.75, -73.95]]}, ...]
+# results are streamed back as NDJSON, one line per query in input order:
+#   {"index": 0, "query": {...}, "result": ...} or {"index": 1, "error": "..."}
+
+# number of queries computed together
+API_CHUNK = 256
+
+def api_queries(task):
+    body = request.get_json(force=True, silent=True)
+    if isinstance(body, dict):
+        body = [{'uid': uid} for uid in body['uids']] if task == 2 and 'uids' in body else body.get('queries')
+    if not isinstance(body, list):
+        abort(400, 'send a JSON array of queries')
+    return [{'uid': item} if task == 2 and isinstance(item, int) else item for item in body]
+
+def stream_results(task, items):
+    # the response is generated after the view returns: each chunk pins the tables of the request's city
+    shard = kdsp.tables()
+
+    def generate():
+        for start in range(0, len(items), API_CHUNK):
+            lines = [None] * len(items[start:start + API_CHUNK])
+            with kdsp.pinned(shard):
+                valid = list()
+                for i, item in enumerate(items[start:start + API_CHUNK]):
+                    try:
+                        valid.append((i, queries.normalizeQuery(dict(item, task=task))))
+                    except (ValueError, KeyError, TypeError) as e:
+                        lines[i] = {'index': start + i, 'error': str(e)}
+
+                # one batch computation for the queries missing from the caches
+                keys = [queries.queryKey(query) for _, query in valid]
+                results = kdsp.cachedResults(keys, lambda positions: queries.runQueries(task, [valid[p][1] for p in positions]))
+                for (i, query), result in zip(valid, results):
+                    lines[i] = {'index': start + i, 'query': query, 'result': result}
+
+            yield ''.join(json.dumps(line) + '\n' for line in lines)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/v1/recommend1', methods=['POST'])
+@by_city
+def api_recommend1():
+    return stream_results(1, api_queries(1))
+
+@app.route('/api/v1/recommend2', methods=['POST'])
+@by_city
+def api_recommend2():
+    return stream_results(2, api_queries(2))
+
+@app.route('/api/v1/recommend3', methods=['POST'])
+@by_city
+def api_recommend3():
+    return stream_results(3, api_queries(3))
+
+
+############################## asynchronous jobs
+# POST one query to /api/v1/jobs/recommend1, 2 or 3 (same fields as the batch API): the answer comes at once with
+#   {"job": "<id>", "state": "pending", "status": "/api/v1/jobs/<id>", "events": "/api/v1/jobs/<id>/events"}
+# (status 200 with the result when an identical job has already finished, 202 otherwise, 503 when the queue is full)
+# GET /api/v1/jobs/<id> returns the job ({"state": "done", "result": ...}); ?wait=10 waits up to 10 s for it to finish.
+# GET /api/v1/jobs/<id>/events is a server-sent event stream that sends the job when it finishes.
+# jobs run on a few threads (KDSP_JOB_WORKERS), so slow computations never hold every request thread; identical
+# queries share one job while it runs and for KDSP_JOB_TTL seconds after it finishes.
+
+job_queue = jobs.JobQueue(int(os.environ.get('KDSP_JOB_WORKERS', 2)), int(os.environ.get('KDSP_JOB_QUEUE', 256)),
+                          float(os.environ.get('KDSP_JOB_TTL', 600)))
+# longest wait of a status request (s), and interval of the keep-alive comments of an event stream
+JOB_WAIT_MAX = 30
+JOB_KEEPALIVE = 15
+
+def submit_job(city, query, job_id=None):
+    shard = kdsp.shardTables(city)
+    key = queries.queryKey(query)
+
+    def compute():
+        with kdsp.pinned(shard):
+            return kdsp.cachedResult(key, lambda: queries.runQuery(query))
+
+    job = job_queue.submit((city, shard['fingerprint'], key), compute, job_id)
+    # recorded in the result store: a status request reaching another worker process (serve.py) picks the job up there
+    kdsp.result_store.putJob(job.id, {'city': city, 'query': query}, job_queue.ttl)
+    return job
+
+def job_view(job):
+    return dict(job.view(), status=url_for('api_job', job_id=job.id), events=url_for('api_job_events', job_id=job.id))
+
+def find_job(job_id):
+    if (job := job_queue.get(job_id)) is not None:
+        return job
+    if (record := kdsp.result_store.getJob(job_id)) is None:
+        abort(404, 'unknown or expired job')
+    try:
+        return submit_job(record['city'], record['query'], job_id)
+    except KeyError:
+        abort(404, 'unknown city ' + record['city'])
+    except OSError:
+        abort(503, 'the dataset of ' + record['city'] + ' is not available')
+    except jobs.QueueFull as e:
+        abort(503, str(e))
+
+@app.route('/api/v1/jobs/recommend<int:task>', methods=['POST'])
+@by_city
+def api_submit_job(task):
+    query = request.get_json(force=True, silent=True)
+    if task not in (1, 2, 3) or not isinstance(query, dict):
+        abort(400, 'send one query as a JSON object')
+    try:
+        query = queries.normalizeQuery(dict(query, task=task))
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        job = submit_job(g.city, query)
+    except jobs.QueueFull as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+    return jsonify(job_view(job)), 200 if job.done.is_set() else 202
+
+@app.route('/api/v1/jobs/<job_id>')
+def api_job(job_id):
+    job = find_job(job_id)
+    job.done.wait(min(request.args.get('wait', 0, type=float), JOB_WAIT_MAX))
+    return jsonify(job_view(job))
+
+@app.route('/api/v1/jobs/<job_id>/events')
+def api_job_events(job_id):
+    job = find_job(job_id)
+
+    def generate():
+        yield 'event: ' + job.state + '\ndata: ' + json.dumps(job.view()) + '\n\n'
+        if job.done.is_set():
+            return
+        while not job.done.wait(JOB_KEEPALIVE):
+            yield ': keep-alive\n\n'
+        yield 'event: ' + job.state + '\ndata: ' + json.dumps(job.view()) + '\n\n'
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
-    return render_template('recommend3_out.html', recommended = recommended)
 
+# the app is complete: load the engine while the server starts (see KDSP_WARMUP)
+if WARMUP == 'background':
+    threading.Thread(target=warm, name='kdsp-warmup', daemon=True).start()
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # development server (KDSP_DEBUG=1 for the debugger and reloader); use serve.py in production
+    app.run(debug=os.environ.get('KDSP_DEBUG') == '1')
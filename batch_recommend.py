@@ -0,0 +1,151 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import KDSP_Task3_V1 as kdsp
+import queries
+from result_store import ResultStore, RESULTS_PATH
+
+# Offline batch job: computes recommendations for a file of queries in a process pool and streams them to the result store
+# usage:
+#   python batch_recommend.py queries.jsonl            (JSON lines or CSV: see queries.py)
+#   python batch_recommend.py --all-users --categories "Bar,Coffee Shop"
+# the data is loaded once in this process; on systems with fork the workers share it copy-on-write,
+# elsewhere each worker opens the memory-mapped dataset cache.
+
+
+# Function that reads the queries to run (lazily, one at a time)
+# yield_errors: a line that can not be parsed is yielded as its ValueError instead of stopping the reading
+def readQueries(path, yield_errors=False):
+    with (sys.stdin if path == '-' else open(path, encoding='utf-8')) as f:
+        csv_columns = None
+        for line in f:
+            if not line.strip():
+                continue
+            if csv_columns is None and not line.lstrip().startswith('{') and line.startswith('task'):
+                # CSV header
+                csv_columns = [c.strip() for c in line.strip().split(',')]
+                continue
+            try:
+                query = queries.parseQueryLine(line, csv_columns)
+            except ValueError as e:
+                if not yield_errors:
+                    raise
+                query = e
+            yield query
+
+
+# Function that generates task 2 for every user and task 1 for every user x category
+def allUserQueries(categories):
+    for uid in kdsp.tables()['counts']['user_ids'].tolist():
+        yield {'task': 2, 'uid': uid}
+        for category in categories:
+            yield {'task': 1, 'uid': uid, 'category': category}
+
+
+# Function that runs a chunk of queries in a worker: returns (key, result) pairs and errors
+def runChunk(chunk):
+    done, errors = [], []
+    for query in chunk:
+        if isinstance(query, ValueError):
+            # a line that could not be parsed
+            errors.append({'error': str(query)})
+            continue
+        try:
+            query = queries.normalizeQuery(query)
+            done.append((queries.queryKey(query), queries.runQuery(query)))
+        except (ValueError, KeyError, TypeError) as e:
+            errors.append({'query': query, 'error': str(e)})
+    return done, errors
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Function that runs every query in the pool; at most 2 chunks per worker are in flight, so memory stays bounded
+def runBatch(items, store, workers=None, chunk_size=256, skip_done=True):
+    # every table is built before the workers are forked, so they share it instead of each building its own
+    fingerprint = kdsp.warmup(full=True)['fingerprint']
+    workers = workers or multiprocessing.cpu_count()
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    stats = {'queries': 0, 'stored': 0, 'skipped': 0, 'errors': 0}
+    start = time.time()
+
+    if skip_done:
+        items = skipStored(items, store, fingerprint, stats)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        pending = []
+        for chunk in chunked(items, chunk_size):
+            pending.append(pool.submit(runChunk, chunk))
+            if len(pending) >= 2 * workers:
+                collect(pending.pop(0), store, fingerprint, stats)
+        for future in pending:
+            collect(future, store, fingerprint, stats)
+
+    stats['seconds'] = round(time.time() - start, 3)
+    return stats
+
+
+def skipStored(items, store, fingerprint, stats):
+    for query in items:
+        if isinstance(query, ValueError):
+            # reported by the worker
+            yield query
+            continue
+        try:
+            key = queries.queryKey(queries.normalizeQuery(query))
+        except (ValueError, KeyError, TypeError):
+            # reported by the worker
+            yield query
+            continue
+        if store.get(fingerprint, key) is None:
+            yield query
+        else:
+            stats['skipped'] += 1
+
+
+def collect(future, store, fingerprint, stats):
+    done, errors = future.result()
+    store.putMany(fingerprint, done)
+    stats['queries'] += len(done) + len(errors)
+    stats['stored'] += len(done)
+    stats['errors'] += len(errors)
+    for error in errors:
+        print(json.dumps(error), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute recommendations into the result store")
+    parser.add_argument('queries', nargs='?', help="query file (JSON lines or CSV, '-' for stdin)")
+    parser.add_argument('--all-users', action='store_true', help="task 2 for every user (+ task 1 for --categories)")
+    parser.add_argument('--categories', default='', help="comma separated category names for --all-users")
+    parser.add_argument('--store', default=RESULTS_PATH)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--recompute', action='store_true', help="recompute queries already in the store")
+    parser.add_argument('--prune', action='store_true', help="delete results of other dataset versions")
+    args = parser.parse_args()
+
+    if not args.queries and not args.all_users:
+        parser.error("give a query file or --all-users")
+
+    store = ResultStore(args.store)
+    if args.prune:
+        store.prune(kdsp.tables()['fingerprint'])
+
+    # a malformed line is reported with the errors instead of stopping the run
+    items = readQueries(args.queries, yield_errors=True) if args.queries else allUserQueries([c.strip() for c in args.categories.split(',') if c.strip()])
+    stats = runBatch(items, store, args.workers, args.chunk_size, skip_done=not args.recompute)
+    print(json.dumps(stats))
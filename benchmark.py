@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Windows: no peak RSS from the standard library
+    resource = None
+
+# Benchmark of the three recommenders on any dataset in the format of dataset_NYC.txt (see synthetic_data.py)
+# records startup time, latency percentiles of every task and of each of its stages, and peak memory,
+# and saves them as JSON so two versions of the code can be compared:
+#   python synthetic_data.py big.txt --users 20000 --venues 500000 --checkins 10000000
+#   python benchmark.py --dataset big.txt --out before.json
+#   (change the code)
+#   python benchmark.py --dataset big.txt --out after.json
+#   python benchmark.py --compare before.json after.json
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+# Function that returns the peak resident memory of the process in MB (None where it is not available)
+def peakRSS():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+# Function that summarises the durations (s) of one stage in milliseconds
+def summarise(samples):
+    ms = np.array(samples) * 1000
+    stats = {'count': len(ms), 'mean_ms': float(ms.mean()), 'max_ms': float(ms.max())}
+    for p, value in zip(PERCENTILES, np.percentile(ms, PERCENTILES)):
+        stats['p' + str(p) + '_ms'] = float(value)
+    return stats
+
+
+class Timings:
+
+    def __init__(self):
+        self.samples = dict()
+
+    # Function that runs fn(*args), records its duration under name and returns its result
+    def time(self, name, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        self.samples.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        return {name: summarise(samples) for name, samples in self.samples.items()}
+
+
+# Function that imports the recommender module on the given dataset and times its startup: the module import
+# (libraries are loaded lazily), the libraries, then the dataset load and table build (kdsp.warmup)
+def startup(dataset, cold):
+    if dataset:
+        os.environ['KDSP_DATASET'] = dataset
+    import dataset_cache
+    import shards
+
+    registry = shards.readRegistry(os.environ.get('KDSP_REGISTRY', shards.REGISTRY_PATH))
+    path = os.environ.get('KDSP_DATASET') or registry['cities'][os.environ.get('KDSP_CITY', registry['default'])]['path']
+    if cold:
+        # first start on this file: parse the text file and write the columnar cache
+        shutil.rmtree(dataset_cache.cacheDirFor(path), ignore_errors=True)
+
+    start = time.perf_counter()
+    import KDSP_Task3_V1 as kdsp
+    module = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import pandas, scipy.sparse, sklearn.cluster, folium
+    # (attribute reads: the lazily imported modules are executed on first use)
+    pandas.DataFrame, scipy.sparse.csr_matrix
+    libraries = time.perf_counter() - start
+
+    start = time.perf_counter()
+    kdsp.warmup(full=True)
+    load = time.perf_counter() - start
+
+    return kdsp, {'cold': cold, 'import_s': module, 'libraries_s': libraries, 'load_s': load,
+                  'total_s': module + libraries + load, 'rss_mb': peakRSS(), 'report': kdsp.startupReport()}
+
+
+# Function that times each table build stage again on the loaded data (warmup builds them once at start)
+def startupStages(kdsp):
+    timings = Timings()
+    data, _ = timings.time('open_dataset', kdsp.dataset_cache.loadDataset, kdsp.PATH, kdsp.readCheckins)
+    counts = timings.time('count_store', kdsp.buildCountStore, data)
+    fingerprint = timings.time('fingerprint', kdsp.datasetFingerprint, counts)
+    venues = timings.time('venue_table', kdsp.buildVenueTable, data, counts)
+    timings.time('category_index', kdsp.buildCategoryIndex, counts)
+    timings.time('venue_index', kdsp.VenueIndex, venues['table'])
+    timings.time('user_vectors', kdsp.buildUserVectors, counts['by_name'])
+    timings.time('neighbour_table', kdsp.loadNeighbourTable, fingerprint)
+    timings.time('category_clusters', kdsp.loadCategoryClusters, counts, fingerprint)
+    timings.time('time_index', kdsp.buildTimeIndex, data, counts, venues)
+    return {name: samples[0] * 1000 for name, samples in timings.samples.items()}
+
+
+# Function that draws the benchmark queries: users uniformly, categories by their number of check-ins,
+# Task 3 locations around random venues
+def makeQueries(kdsp, n, group, seed):
+    rng = np.random.default_rng(seed)
+    t = kdsp.tables()
+    counts = t['counts']
+
+    users = rng.choice(counts['user_ids'], size=(n, group))
+    frequencies = np.asarray(counts['by_name'].sum(axis=0)).ravel().astype(float)
+    categories = rng.choice(counts['category_names'], size=n, p=frequencies / frequencies.sum())
+
+    coords = t['venue_index'].coords
+    locs = coords[rng.integers(0, len(coords), size=(n, group))] + rng.normal(0, 0.01, size=(n, group, 2))
+
+    return [(int(users[i, 0]), str(categories[i]), users[i].tolist(), locs[i]) for i in range(n)]
+
+
+# Function that runs every query through each task, timing the whole task and each of its stages
+# (the recommenders are called directly, so the result caches do not hide the work)
+def runTasks(kdsp, queries):
+    timings = Timings()
+    for uid, category, uids, locs in queries:
+        with kdsp.pinned():
+            # Task 1: candidate venues of the similar categories, then the user's frequent places and the filter
+            timings.time('task1', kdsp.recommendVenueFromIDandCategory, uid, category)
+            rows = timings.time('task1.similar_categories', kdsp.similarCategoryRows, category)
+            freq_category = timings.time('task1.freq_category', kdsp.getFreqCategory, uid)
+            freq_loc = timings.time('task1.freq_loc', kdsp.getFreqLoc, freq_category)
+            timings.time('task1.outliers', kdsp.getOutlier, freq_loc['per'])
+            timings.time('task1.select', kdsp.selectVenues, uid, rows)
+
+            # Task 2: as served (neighbour table when present) and the exact top-k search
+            timings.time('task2', kdsp.recommendUsersFromID, uid)
+            position = np.array([kdsp.tables()['counts']['user_pos'][uid]])
+            timings.time('task2.top_k', kdsp.topKSimilar, position, 10)
+
+            # Task 3: centre of the locations, candidate venues around it, then the scoring of the candidates
+            timings.time('task3', kdsp.recommendMeetingPointFromIDsandLocs, uids, locs)
+            mid = timings.time('task3.center', kdsp.geometricMedian, locs)
+            timings.time('task3.candidates', kdsp.tables()['venue_index'].nearest, mid, kdsp.MEETING_CANDIDATES, None, 'haversine')
+            timings.time('task3.top_k', kdsp.recommendMeetingVenues, uids, locs, 10)
+
+    return timings.summary()
+
+
+# Function that measures the peak Python/numpy allocation of one call of each task (MB, tracemalloc)
+# run apart from the timed queries: tracing slows every allocation down
+def taskMemory(kdsp, queries):
+    calls = {
+        'task1': lambda q: kdsp.recommendVenueFromIDandCategory(q[0], q[1]),
+        'task2': lambda q: kdsp.topKSimilar(np.array([kdsp.tables()['counts']['user_pos'][q[0]]]), 10),
+        'task3': lambda q: kdsp.recommendMeetingPointFromIDsandLocs(q[2], q[3]),
+    }
+    peaks = dict()
+    tracemalloc.start()
+    for task, call in calls.items():
+        peak = 0
+        for query in queries:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            call(query)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+        peaks[task] = peak / 2**20
+    tracemalloc.stop()
+    return peaks
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Function that runs the whole benchmark and returns the results (JSON-compatible)
+def runBenchmark(dataset=None, queries=200, warmup=20, group=5, cold=False, seed=0, label=None):
+    kdsp, start = startup(dataset, cold)
+    counts = kdsp.tables()['counts']
+
+    drawn = makeQueries(kdsp, warmup + queries, group, seed)
+    runTasks(kdsp, drawn[:warmup])
+    tasks = runTasks(kdsp, drawn[warmup:])
+
+    return {
+        'label': label,
+        'commit': gitCommit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'dataset': {
+            'path': kdsp.PATH,
+            'rows': len(kdsp.df),
+            'users': len(counts['user_ids']),
+            'venues': len(kdsp.tables()['venues']['table']),
+            'categories': len(counts['category_ids']),
+            'category_names': len(counts['category_names']),
+        },
+        'startup': dict(start, stages_ms=startupStages(kdsp)),
+        'queries': queries,
+        'tasks': tasks,
+        'memory': {
+            'startup_rss_mb': start['rss_mb'],
+            'peak_rss_mb': peakRSS(),
+            'dataset_resident_mb': kdsp.memory_report['resident_bytes'] / 2**20,
+            'task_peak_alloc_mb': taskMemory(kdsp, drawn[warmup:warmup + min(queries, 20)]),
+        },
+    }
+
+
+# Function that prints the change of every measure between two saved results
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    def row(name, a, b):
+        if a is None or b is None:
+            return
+        ratio = b / a if a else float('inf')
+        print("%-34s %12.3f %12.3f %8.2fx" % (name, a, b, ratio))
+
+    print("%-34s %12s %12s %9s" % ('', before.get('label') or before.get('commit'), after.get('label') or after.get('commit'), 'after/before'))
+    row('startup total (s)', before['startup']['total_s'], after['startup']['total_s'])
+    for stage in before['startup']['stages_ms']:
+        row('  ' + stage + ' (ms)', before['startup']['stages_ms'][stage], after['startup']['stages_ms'].get(stage))
+    for stage in before['tasks']:
+        if stage in after['tasks']:
+            for p in ['p50_ms', 'p99_ms']:
+                row(stage + ' ' + p, before['tasks'][stage][p], after['tasks'][stage][p])
+    row('peak RSS (MB)', before['memory']['peak_rss_mb'], after['memory']['peak_rss_mb'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the three recommenders and save the results as JSON")
+    parser.add_argument('--dataset', help="check-in file (default: KDSP_DATASET or the NYC dataset)")
+    parser.add_argument('--queries', type=int, default=200, help="timed queries per task")
+    parser.add_argument('--warmup', type=int, default=20, help="untimed queries run first")
+    parser.add_argument('--group', type=int, default=5, help="users per Task 3 query")
+    parser.add_argument('--cold', action='store_true', help="drop the dataset cache first, to time a first start")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', help="name of this run in the results (default: the git commit)")
+    parser.add_argument('--out', help="write the results to this JSON file")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two saved results and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    results = runBenchmark(args.dataset, args.queries, args.warmup, args.group, args.cold, args.seed, args.label)
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    print(text)
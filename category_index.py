@@ -0,0 +1,95 @@
+import sys
+import numpy as np
+
+# longest n-gram kept in the substring index
+NGRAM = 3
+
+
+def ngrams(text, n):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+# Category dictionary built at load: VenueCategoryID -> name, name -> IDs, name -> frequency rank,
+# and an n-gram index over the names for substring lookups (category validation and autocomplete)
+# (appended check-ins only rerank the names, see reranked)
+class CategoryIndex:
+
+    def __init__(self, category_ids, id_names, names, frequencies):
+        # category_ids / id_names: every VenueCategoryID and its VenueCategoryName
+        # names / frequencies: every VenueCategoryName and its number of check-ins
+        self.id_to_name = {_id: sys.intern(str(name)) for _id, name in zip(category_ids, id_names)}
+
+        self.rankNames(names, frequencies)
+
+        self.name_to_ids = {name: [] for name in self.names}
+        for _id, name in self.id_to_name.items():
+            self.name_to_ids[name].append(_id)
+
+        # n-gram (1 to NGRAM characters, lower case) -> positions in names of the names containing it, ascending
+        # (positions, not ranks: a change of the frequencies reorders the names without rebuilding the postings)
+        postings = dict()
+        for code, name in enumerate(self.by_code):
+            lower = name.lower()
+            for n in range(1, NGRAM + 1):
+                for gram in ngrams(lower, n):
+                    postings.setdefault(gram, []).append(code)
+        self.postings = {gram: np.array(codes, dtype=np.int32) for gram, codes in postings.items()}
+
+    # Function that orders the names by frequency (names / frequencies as in __init__)
+    def rankNames(self, names, frequencies):
+        self.by_code = [sys.intern(str(name)) for name in names]
+        # names ordered by frequency (most visited first), as df['VenueCategoryName'].value_counts() does
+        order = np.argsort(-np.asarray(frequencies), kind='stable')
+        self.names = [self.by_code[i] for i in order]
+        self.rank = {name: r for r, name in enumerate(self.names)}
+        # rank of each position in names
+        self.code_rank = np.empty(len(order), dtype=np.int64)
+        self.code_rank[order] = np.arange(len(order))
+
+    # Function that returns the index with new frequencies of the same names (the dictionaries and postings are shared)
+    def reranked(self, frequencies):
+        index = CategoryIndex.__new__(CategoryIndex)
+        index.id_to_name, index.name_to_ids, index.postings = self.id_to_name, self.name_to_ids, self.postings
+        index.rankNames(self.by_code, frequencies)
+        return index
+
+    # Function that returns the VenueCategoryName of a VenueCategoryID (None if unknown)
+    def name(self, _id):
+        return self.id_to_name.get(_id)
+
+    # Function that returns the VenueCategoryIDs sharing a VenueCategoryName
+    def ids(self, name):
+        return self.name_to_ids.get(name, [])
+
+    # Function that returns the ranks of every name containing text, most frequent first
+    def search(self, text, ignore_case=False):
+        lower = text.lower()
+        if lower == "":
+            return list(range(len(self.names)))
+
+        # candidates: names containing every n-gram of the text, then checked exactly
+        n = min(NGRAM, len(lower))
+        candidates = None
+        for gram in ngrams(lower, n):
+            codes = self.postings.get(gram)
+            if codes is None:
+                return []
+            candidates = codes if candidates is None else np.intersect1d(candidates, codes, assume_unique=True)
+
+        candidates = np.sort(self.code_rank[candidates])
+        if ignore_case:
+            return [r for r in candidates.tolist() if lower in self.names[r].lower()]
+        return [r for r in candidates.tolist() if text in self.names[r]]
+
+    # Function that returns the most frequent VenueCategoryName containing text (None if there is none)
+    def match(self, text):
+        found = self.search(text)
+        return self.names[found[0]] if found else None
+
+    # Function that suggests up to limit names for a typed text: names starting with it first, then by frequency
+    def complete(self, text, limit=10):
+        text = text.strip()
+        lower = text.lower()
+        found = self.search(text, ignore_case=True)
+        found.sort(key=lambda r: (not self.names[r].lower().startswith(lower), r))
+        return [self.names[r] for r in found[:limit]]
@@ -0,0 +1,174 @@
+import json
+import os
+import numpy as np
+from lazy_import import lazyModule
+pd = lazyModule('pandas')
+
+# Columnar binary cache of the check-in log
+# one memory-mapped .npy file per column: strings are stored as integer codes + a sorted dictionary,
+# coordinates as float32 (about 1e-5 degree, i.e. under 1 m: not an exact copy of the file's 6 decimals)
+# and ids as the smallest int type that fits.
+# UTCTime and TimezoneOffsetInMin are parsed once into one int64 column, LocalTime: the local time of the check-in
+# in seconds since 1970-01-01 (as if the local clock were UTC), NO_TIME when the time is missing or unreadable.
+
+# bump when the cache layout changes, so caches written by older code are rebuilt
+CACHE_VERSION = 3
+CODED_COLUMNS = ['VenueID', 'VenueCategoryID', 'VenueCategoryName']
+FLOAT_COLUMNS = ['Latitude', 'Longitude']
+NO_TIME = np.iinfo(np.int64).min
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+# Function that returns the default cache directory of a dataset file (next to it)
+def cacheDirFor(path):
+    return os.path.splitext(path)[0] + '_cache'
+
+
+def sourceStamp(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def smallestInt(values):
+    for dtype in [np.int8, np.int16, np.int32]:
+        info = np.iinfo(dtype)
+        if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return dtype
+    return np.int64
+
+
+# Function that parses UTCTime values ("Tue Apr 03 18:00:09 +0000 2012") into seconds since 1970-01-01 (UTC)
+# the fixed-width fields are read as digits straight from the bytes; values in any other layout go through pandas
+def parseUTCTimes(values):
+    values = pd.Series(values, dtype=object).fillna('').astype(str).to_numpy()
+    raw = np.asarray(values, dtype='S30')
+    b = raw.view(np.uint8).reshape(len(raw), 30).astype(np.int64)
+
+    def digits(start, width):
+        return sum((b[:, start + i] - 48) * 10 ** (width - 1 - i) for i in range(width))
+
+    month_keys = np.array([ord(m[0]) << 16 | ord(m[1]) << 8 | ord(m[2]) for m in MONTHS])
+    key = b[:, 4] << 16 | b[:, 5] << 8 | b[:, 6]
+    month = np.argmax(month_keys[None, :] == key[:, None], axis=1)
+    days = ((digits(26, 4) - 1970) * 12 + month).astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    seconds = (days + digits(8, 2) - 1) * 86400 + digits(11, 2) * 3600 + digits(14, 2) * 60 + digits(17, 2)
+
+    fixed = (np.char.str_len(values.astype(str)) == 30) & (month_keys[month] == key) & (b[:, 20:25] == np.frombuffer(b'+0000', np.uint8)).all(axis=1)
+    digit_cols = b[:, [8, 9, 11, 12, 14, 15, 17, 18, 26, 27, 28, 29]]
+    fixed &= ((digit_cols >= 48) & (digit_cols <= 57)).all(axis=1)
+    if not fixed.all():
+        parsed = pd.to_datetime(pd.Series(values[~fixed]), errors='coerce', utc=True, format='mixed')
+        seconds[~fixed] = np.where(parsed.isna(), NO_TIME, parsed.dt.tz_localize(None).to_numpy().astype('datetime64[s]').astype(np.int64))
+    return seconds
+
+
+# Function that returns the local time (seconds, see LocalTime above) of every check-in of a data frame
+# (the cached column, or parsed from UTCTime and TimezoneOffsetInMin)
+def localTimes(data):
+    if 'LocalTime' in data:
+        return data['LocalTime'].to_numpy(dtype=np.int64)
+    if 'UTCTime' not in data:
+        return np.full(len(data), NO_TIME, dtype=np.int64)
+
+    seconds = parseUTCTimes(data['UTCTime'])
+    offsets = pd.to_numeric(data['TimezoneOffsetInMin'], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    return np.where(seconds == NO_TIME, NO_TIME, seconds + offsets * 60)
+
+
+# Function that checks whether the cache is missing or was built from another version of the source file
+def isStale(path, cache_dir):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return True
+    if not os.path.exists(path):
+        # no source to compare against (e.g. a deployment shipping only the cache): trust the cache
+        return False
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta.get('version') != CACHE_VERSION or meta.get('source') != sourceStamp(path)
+
+
+# Function that converts a parsed check-in data frame into the columnar cache (one-time conversion)
+def writeCache(data, path, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    user_ids = data['UserID'].to_numpy()
+    np.save(os.path.join(cache_dir, 'UserID.npy'), user_ids.astype(smallestInt(user_ids)))
+    # sorted distinct users: UserIDs are checked against them without opening the rest of the dataset
+    np.save(os.path.join(cache_dir, 'UserIDs.npy'), np.unique(user_ids).astype(np.int64))
+
+    for col in CODED_COLUMNS:
+        # sorted dictionary: codes keep the order of the original string values
+        codes, uniques = pd.factorize(data[col], sort=True)
+        np.save(os.path.join(cache_dir, col + '.codes.npy'), codes.astype(smallestInt(codes)))
+        np.save(os.path.join(cache_dir, col + '.dict.npy'), np.asarray(uniques, dtype=str))
+
+    for col in FLOAT_COLUMNS:
+        np.save(os.path.join(cache_dir, col + '.npy'), data[col].to_numpy(dtype=np.float32))
+
+    np.save(os.path.join(cache_dir, 'LocalTime.npy'), localTimes(data))
+
+    meta = {
+        'version': CACHE_VERSION,
+        'source': sourceStamp(path),
+        'rows': len(data),
+        # resident size of the data frame parsed from the text file, to report what the cache saves
+        'source_bytes': int(data.memory_usage(deep=True).sum()),
+    }
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+# Function that opens the cache as a data frame without copying the columns (memory-mapped)
+def readCache(cache_dir):
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        meta = json.load(f)
+
+    data = {'UserID': np.load(os.path.join(cache_dir, 'UserID.npy'), mmap_mode='r')}
+    for col in CODED_COLUMNS:
+        codes = np.load(os.path.join(cache_dir, col + '.codes.npy'), mmap_mode='r')
+        uniques = np.load(os.path.join(cache_dir, col + '.dict.npy'))
+        data[col] = pd.Categorical.from_codes(codes, categories=pd.Index(uniques.astype(object)), validate=False)
+    for col in FLOAT_COLUMNS:
+        data[col] = np.load(os.path.join(cache_dir, col + '.npy'), mmap_mode='r')
+    data['LocalTime'] = np.load(os.path.join(cache_dir, 'LocalTime.npy'), mmap_mode='r')
+
+    return pd.DataFrame(data, copy=False), meta
+
+
+# Function that loads the dataset from the cache, (re)building the cache from the text file only when it is stale
+# read_tsv: function that parses the original tab separated file into a data frame
+# returns (data frame, memory report)
+def loadDataset(path, read_tsv, cache_dir=None):
+    cache_dir = cache_dir or cacheDirFor(path)
+
+    if isStale(path, cache_dir):
+        try:
+            writeCache(read_tsv(path), path, cache_dir)
+        except OSError:
+            # read-only data directory: run from the text file, without a cache
+            data = read_tsv(path)
+            size = int(data.memory_usage(deep=True).sum())
+            return data, {'cache': None, 'resident_bytes': size, 'source_bytes': size, 'saved_bytes': 0}
+
+    data, meta = readCache(cache_dir)
+    resident = int(data.memory_usage(deep=True).sum())
+    report = {
+        'cache': cache_dir,
+        'resident_bytes': resident,
+        'source_bytes': meta['source_bytes'],
+        'saved_bytes': meta['source_bytes'] - resident,
+    }
+    return data, report
+
+
+# Function that returns the sorted distinct UserIDs of the dataset (read from the cache, a few KB)
+# the dataset is loaded (and the cache rebuilt) only when the cache is stale
+def loadUserIDs(path, read_tsv, cache_dir=None):
+    cache_dir = cache_dir or cacheDirFor(path)
+    ids_path = os.path.join(cache_dir, 'UserIDs.npy')
+    if isStale(path, cache_dir) or not os.path.exists(ids_path):
+        data, _ = loadDataset(path, read_tsv, cache_dir)
+        return np.unique(data['UserID'].to_numpy()).astype(np.int64)
+    return np.load(ids_path)
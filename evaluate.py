@@ -0,0 +1,258 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.metrics import silhouette_score
+import KDSP_Task3_V1 as kdsp
+from benchmark import gitCommit, summarise
+from spatial import distanceMatrixKm
+
+# Offline evaluation of the recommenders (replaces forEvaluation.ipynb): every user's latest check-ins are held out,
+# the tables are built once on the other ones, and each setting is scored on the held-out check-ins, settings in
+# parallel processes. quality is measured with the latency of the queries, so a setting can be chosen on both:
+#   clusters (Task 1): silhouette score of the category clusters (as in the notebook);
+#     hit rate: held-out check-ins at a venue new to the user that is among the 10 venues recommended for
+#     (user, category of the check-in); near hit rate: one of the 10 venues is within --radius km of it
+#   similarity (Task 2): hit rate: users who checked into a venue (held out) visited by one of their 10 similar users;
+#     precision: share of the similar users who visited one of the user's held-out venues;
+#     venue recall: share of the user's held-out venues visited by one of the similar users
+# usage: python evaluate.py --clusters auto,6,10,14 --similarity exact,lsh:16/8/1,lsh:12/4/0 --workers 4 --out report.json
+
+# held-out data and tables built on the rest (set before the worker processes are forked, which share it)
+STATE = None
+
+
+def textList(text):
+    return [v.strip() for v in text.split(',') if v.strip()]
+
+
+# Function that splits the check-in log in time: the latest share `holdout` of the check-ins of every user with at
+# least min_checkins of them is held out; returns (train rows, held-out rows), each in log order
+def splitCheckins(data, holdout, min_checkins):
+    times = kdsp.dataset_cache.localTimes(data)
+    users = data['UserID'].to_numpy()
+    # rows grouped by user, each user's check-ins by time (check-ins without a time first: they are never held out)
+    order = np.lexsort((times, users))
+    _, starts, sizes = np.unique(users[order], return_index=True, return_counts=True)
+    held = np.where(sizes >= min_checkins, np.floor(sizes * holdout).astype(np.int64), 0)
+
+    rank = np.arange(len(order)) - np.repeat(starts, sizes)
+    test = rank >= np.repeat(sizes - held, sizes)
+    return np.sort(order[~test]), np.sort(order[test])
+
+
+# Function that builds the training tables and the evaluation queries from the loaded check-in log
+def prepare(users, per_user, holdout, min_checkins, seed):
+    data = kdsp.df
+    train_rows, test_rows = splitCheckins(data, holdout, min_checkins)
+
+    # the cluster table fitted for the training data goes to a scratch directory (the saved one is left alone)
+    scratch = tempfile.mkdtemp()
+    try:
+        train = kdsp.buildTables(data.iloc[train_rows].reset_index(drop=True), '', os.path.join(scratch, 'clusters.npz'))
+        train['neighbours'] = None
+        train['user_lsh'] = None
+        # every table is built now: the settings copy the tables (dict(train)) in the forked workers
+        train.build()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    counts = train['counts']
+    venues = train['venues']
+    test = data.iloc[test_rows]
+    test_users = np.array([uid for uid in pd.unique(test['UserID'].to_numpy()) if uid in counts['user_pos']])
+    rng = np.random.default_rng(seed)
+    test_users = set(rng.choice(test_users, size=min(users, len(test_users)), replace=False).tolist())
+
+    task1, task2 = [], []
+    venue_rows = kdsp.venueRows(venues, test['VenueID'])
+    known_category = counts['name_index'].get_indexer(test['VenueCategoryName']) >= 0
+    for uid, group in groupRows(test['UserID'].to_numpy()):
+        if uid not in test_users:
+            continue
+        pos = counts['user_pos'][uid]
+        visited = set(venues['visited'].indices[venues['visited'].indptr[pos]:venues['visited'].indptr[pos + 1]].tolist())
+
+        # Task 1: held-out check-ins at venues the user had not visited, in categories known before the split
+        picked = [i for i in group if known_category[i] and venue_rows[i] not in visited][:per_user]
+        task1 += [(uid, str(test['VenueCategoryName'].iloc[i]), str(test['VenueID'].iloc[i]),
+                   float(test['Latitude'].iloc[i]), float(test['Longitude'].iloc[i])) for i in picked]
+
+        # Task 2: the user's held-out venues that were visited by anyone before the split
+        held = np.unique(venue_rows[group])
+        if len(held := held[held >= 0]) > 0:
+            task2.append((uid, held))
+
+    return {'train': train, 'shares': kdsp.categoryShares(counts), 'task1': task1, 'task2': task2,
+            'split': {'train_checkins': len(train_rows), 'held_out_checkins': len(test_rows), 'users': len(test_users)}}
+
+
+# Function that returns (value, positions) for each value of an array, in order of first appearance
+def groupRows(values):
+    order = np.argsort(values, kind='stable')
+    _, starts = np.unique(values[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    return sorted(((values[g[0]], g) for g in groups), key=lambda item: item[1][0])
+
+
+# Function that scores Task 1 with the clusters of one cluster count (None = the default count)
+def evaluateClusters(n_clusters, radius):
+    train = STATE['train']
+    start = time.perf_counter()
+    clustered = kdsp.clusterCategories(train['counts'], kdsp.CLUSTERS_SEED, n_clusters, STATE['shares'])
+    fit_s = time.perf_counter() - start
+
+    labels = clustered['cluster'].to_numpy()
+    n_labels = len(np.unique(labels))
+    silhouette = silhouette_score(clustered[['sum']], labels) if 1 < n_labels < len(labels) else None
+
+    tables = dict(train, category_clusters=clustered[['sum', 'cluster']])
+    hits, near, latency = [], [], []
+    with kdsp.pinned(tables):
+        for uid, category, venue_id, lat, lon in STATE['task1']:
+            start = time.perf_counter()
+            recommended = kdsp.recommendVenueFromIDandCategory(uid, category)
+            latency.append(time.perf_counter() - start)
+
+            hits.append(any(r[0] == venue_id for r in recommended))
+            near.append(len(recommended) > 0 and distanceMatrixKm([[lat, lon]], [r[2:4] for r in recommended]).min() <= radius)
+
+    return {
+        'setting': 'clusters=' + ('auto' if n_clusters is None else str(n_clusters)),
+        'clusters': int(n_labels),
+        'silhouette': None if silhouette is None else float(silhouette),
+        'task1_hit_rate': float(np.mean(hits)) if hits else None,
+        'task1_near_hit_rate': float(np.mean(near)) if near else None,
+        'queries': len(latency),
+        'fit_s': fit_s,
+        'latency': summarise(latency) if latency else None,
+    }
+
+
+# Function that scores Task 2 with one similar-user search: 'exact' or 'lsh:bits/tables/probes'
+def evaluateSimilarity(search):
+    train = STATE['train']
+    start = time.perf_counter()
+    if search == 'exact':
+        tables = dict(train)
+    else:
+        bits, n_tables, probes = map(int, search.split(':', 1)[1].split('/'))
+        tables = dict(train, user_lsh=kdsp.buildUserLSH(train['user_vectors'], bits, n_tables, probes))
+    fit_s = time.perf_counter() - start
+
+    counts = train['counts']
+    visited = train['venues']['visited']
+    hits, precision, recall, latency = [], [], [], []
+    with kdsp.pinned(tables):
+        for uid, held in STATE['task2']:
+            start = time.perf_counter()
+            similar = kdsp.recommendUsersFromID(uid)
+            latency.append(time.perf_counter() - start)
+
+            # similar users who visited one of the user's held-out venues (none when no user shares a category)
+            if not similar:
+                hits.append(False)
+                precision.append(0.0)
+                recall.append(0.0)
+                continue
+            rows = [counts['user_pos'][s] for s in similar]
+            shared = visited[rows][:, held].toarray()
+            hits.append(shared.any())
+            precision.append(shared.any(axis=1).mean())
+            recall.append(shared.any(axis=0).mean())
+
+    return {
+        'setting': 'similarity=' + search,
+        'task2_hit_rate': float(np.mean(hits)) if hits else None,
+        'task2_precision': float(np.mean(precision)) if precision else None,
+        'task2_venue_recall': float(np.mean(recall)) if recall else None,
+        'queries': len(latency),
+        'fit_s': fit_s,
+        'latency': summarise(latency) if latency else None,
+    }
+
+
+def evaluateSetting(setting):
+    kind, value, radius = setting
+    try:
+        if kind == 'clusters':
+            return evaluateClusters(None if value == 'auto' else int(value), radius)
+        return evaluateSimilarity(value)
+    except ValueError as e:
+        return {'setting': kind + '=' + value, 'error': str(e)}
+
+
+# Function that evaluates every setting (in `workers` forked processes) and returns the report (JSON-compatible)
+def runEvaluation(clusters, similarity, users=200, per_user=3, holdout=0.2, min_checkins=5, radius=1.0, workers=1, seed=0):
+    global STATE
+    start = time.perf_counter()
+    STATE = prepare(users, per_user, holdout, min_checkins, seed)
+    prepare_s = time.perf_counter() - start
+
+    settings = [('clusters', v, radius) for v in clusters] + [('similarity', v, radius) for v in similarity]
+    # without fork (e.g. Windows) the settings run one after another in this process
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            results = list(pool.map(evaluateSetting, settings))
+    else:
+        results = [evaluateSetting(setting) for setting in settings]
+
+    return {
+        'commit': gitCommit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'dataset': kdsp.PATH,
+        'holdout': holdout,
+        'radius_km': radius,
+        'default_clusters': kdsp.defaultClusterCount(len(STATE['shares'])),
+        'split': STATE['split'],
+        'queries': {'task1': len(STATE['task1']), 'task2': len(STATE['task2'])},
+        'prepare_s': prepare_s,
+        'results': results,
+    }
+
+
+def printReport(report):
+    print("%d check-ins held out of %d, %d users evaluated (%d Task 1 / %d Task 2 queries); default cluster count %d"
+          % (report['split']['held_out_checkins'], report['split']['held_out_checkins'] + report['split']['train_checkins'],
+             report['split']['users'], report['queries']['task1'], report['queries']['task2'], report['default_clusters']))
+    for row in report['results']:
+        if 'error' in row:
+            print("%-28s error: %s" % (row['setting'], row['error']))
+            continue
+        if 'clusters' in row:
+            quality = "silhouette %s  hit %.3f  near hit %.3f" % (
+                'n/a' if row['silhouette'] is None else '%.3f' % row['silhouette'], row['task1_hit_rate'] or 0, row['task1_near_hit_rate'] or 0)
+        else:
+            quality = "hit %.3f  precision %.3f  recall %.3f" % (row['task2_hit_rate'] or 0, row['task2_precision'] or 0,
+                                                                  row['task2_venue_recall'] or 0)
+        latency = row['latency'] or {'p50_ms': float('nan'), 'p95_ms': float('nan')}
+        print("%-28s %-44s p50 %7.2f ms  p95 %7.2f ms  fit %.2f s"
+              % (row['setting'], quality, latency['p50_ms'], latency['p95_ms'], row['fit_s']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hold-out evaluation of cluster counts (Task 1) and similar-user searches (Task 2)")
+    parser.add_argument('--clusters', type=textList, default=['auto'], help="cluster counts, e.g. auto,6,10,14")
+    parser.add_argument('--similarity', type=textList, default=['exact'], help="searches, e.g. exact,lsh:16/8/1 (bits/tables/probes)")
+    parser.add_argument('--users', type=int, default=200, help="users evaluated")
+    parser.add_argument('--per-user', type=int, default=3, help="Task 1 queries per user")
+    parser.add_argument('--holdout', type=float, default=0.2, help="share of each user's latest check-ins held out")
+    parser.add_argument('--min-checkins', type=int, default=5, help="users with fewer check-ins are not held out")
+    parser.add_argument('--radius', type=float, default=1.0, help="distance (km) of a Task 1 near hit")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="processes evaluating settings")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = runEvaluation(args.clusters, args.similarity, args.users, args.per_user, args.holdout, args.min_checkins,
+                           args.radius, args.workers, args.seed)
+    printReport(report)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
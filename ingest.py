@@ -0,0 +1,84 @@
+import math
+import os
+import threading
+import KDSP_Task3_V1 as kdsp
+
+# File-tail ingestion: new check-in lines written to a file (same 8-column tab separated format as the dataset)
+# are added to the running engine with kdsp.appendCheckins, without a restart.
+
+
+# Function that reads the complete lines written to path after position
+# returns (lines, new position); a trailing partial line is left for the next read
+def readNewLines(path, position):
+    if os.path.getsize(path) < position:
+        # the file was truncated or replaced: start again from its beginning
+        position = 0
+
+    with open(path, 'rb') as f:
+        f.seek(position)
+        chunk = f.read()
+
+    end = chunk.rfind(b'\n') + 1
+    lines = chunk[:end].decode('utf-8', errors='ignore').splitlines()
+    return [line for line in lines if line.strip()], position + end
+
+
+# Function that returns why a check-in line can not be appended, or None if it is valid
+# (UserID, VenueID, VenueCategoryID, VenueCategoryName, Latitude, Longitude, then optionally TimezoneOffsetInMin, UTCTime)
+def lineError(line):
+    fields = line.rstrip('\r\n').split('\t')
+    if not 6 <= len(fields) <= 8:
+        return "expected 6 to 8 tab separated fields, got " + str(len(fields))
+    if not all(field.strip() for field in fields[1:4]):
+        return "empty VenueID, VenueCategoryID or VenueCategoryName"
+    try:
+        int(fields[0])
+        if not all(math.isfinite(float(value)) for value in fields[4:6]):
+            return "Latitude / Longitude not finite"
+        if len(fields) > 6 and fields[6].strip():
+            int(float(fields[6]))
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+# Function that appends a batch of valid lines; if the batch is still refused, its lines are appended one by one
+# so a single bad line only loses itself
+def appendLines(lines):
+    try:
+        kdsp.appendCheckins(lines)
+    except (ValueError, KeyError) as e:
+        if len(lines) == 1:
+            print("ingest: skipped malformed line (" + str(e) + "): " + lines[0][:200])
+            return
+        for line in lines:
+            appendLines([line])
+
+
+# Function that follows path like `tail -f` and appends new check-ins in batches of at most max_batch rows
+# from_start=False skips the rows already in the file (e.g. when following the dataset file the engine was loaded from)
+# malformed lines are logged and skipped; the valid lines around them are appended
+def followFile(path, interval=1.0, from_start=False, max_batch=10000, stop=None):
+    stop = stop or threading.Event()
+    position = 0 if from_start else os.path.getsize(path)
+
+    while not stop.is_set():
+        lines, position = readNewLines(path, position)
+        valid = list()
+        for line in lines:
+            if (error := lineError(line)) is not None:
+                print("ingest: skipped malformed line (" + error + "): " + line[:200])
+            else:
+                valid.append(line)
+        for i in range(0, len(valid), max_batch):
+            appendLines(valid[i:i + max_batch])
+
+        stop.wait(interval)
+
+
+# Function that starts followFile in a background thread; set the returned event to stop it
+def startFollowing(path, interval=1.0, from_start=False):
+    stop = threading.Event()
+    thread = threading.Thread(target=followFile, args=(path, interval, from_start), kwargs={'stop': stop}, daemon=True)
+    thread.start()
+    return stop
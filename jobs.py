@@ -0,0 +1,122 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Asynchronous jobs for slow requests (app.py /api/v1/jobs): a bounded pool of worker threads runs the jobs while the
+# request that submitted one returns its job ID at once; the caller polls the job or listens to its events.
+# identical jobs (same key) share one computation while they run and for ttl seconds after they finish.
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self, job_id, key):
+        self.id = job_id
+        self.key = key
+        # pending -> running -> done | failed
+        self.state = 'pending'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    # Function that returns the job as a JSON-compatible dict (with the result or error once it has finished)
+    def view(self):
+        view = {'job': self.id, 'state': self.state}
+        if self.state == 'done':
+            view['result'] = self.result
+        elif self.state == 'failed':
+            view['error'] = self.error
+        return view
+
+
+class JobQueue:
+
+    # workers: threads running jobs; max_pending: jobs waiting or running before new ones are refused (QueueFull);
+    # ttl: seconds a finished job (and its result) stays available
+    def __init__(self, workers=2, max_pending=256, ttl=600):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs = dict()
+        self.active = 0
+        self.lock = threading.Lock()
+        self.counters = {'submitted': 0, 'coalesced': 0, 'rejected': 0, 'failed': 0}
+        self._pool = None
+        self._pid = None
+
+    # the pool is started on first use in each process (threads do not survive the fork of serve.py's workers)
+    @property
+    def pool(self):
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='kdsp-job')
+            self._pid = os.getpid()
+        return self._pool
+
+    @staticmethod
+    def jobID(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()[:24]
+
+    # Function that returns the job computing compute() for key: the running or recently finished job of the same key,
+    # or a new job queued on the pool (raises QueueFull when max_pending jobs are waiting or running)
+    def submit(self, key, compute, job_id=None):
+        job_id = job_id or self.jobID(key)
+        with self.lock:
+            self.expire()
+            job = self.jobs.get(job_id)
+            # (failed jobs are run again)
+            if job is not None and job.state != 'failed':
+                self.counters['coalesced'] += 1
+                return job
+            if self.active >= self.max_pending:
+                self.counters['rejected'] += 1
+                raise QueueFull("too many jobs waiting: try again later")
+
+            job = self.jobs[job_id] = Job(job_id, key)
+            self.active += 1
+            self.counters['submitted'] += 1
+
+        self.pool.submit(self.run, job, compute)
+        return job
+
+    def run(self, job, compute):
+        job.state = 'running'
+        try:
+            job.result = compute()
+            job.state = 'done'
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            job.state = 'failed'
+            with self.lock:
+                self.counters['failed'] += 1
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self.active -= 1
+            job.done.set()
+
+    # Function that returns a job by ID, or None if it is unknown or expired
+    def get(self, job_id):
+        with self.lock:
+            self.expire()
+            return self.jobs.get(job_id)
+
+    # Function that drops the jobs finished more than ttl seconds ago (called with the lock held)
+    def expire(self):
+        limit = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished is not None and job.finished < limit]:
+            del self.jobs[job_id]
+
+    # Function that returns the counters and the number of jobs in each state
+    def stats(self):
+        with self.lock:
+            states = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+            for job in self.jobs.values():
+                states[job.state] += 1
+            return dict(self.counters, **states)
@@ -0,0 +1,20 @@
+import importlib.util
+import sys
+
+# Heavy libraries (pandas, scipy) are imported on first use instead of at start, so tools that never touch them
+# (health checks, input validation before the data is loaded, --help) start in a fraction of a second.
+
+
+# Function that returns module `name`, executed on the first access to one of its attributes
+# (a module that is already imported is returned as it is)
+def lazyModule(name):
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,76 @@
+import argparse
+import json
+import time
+import numpy as np
+import KDSP_Task3_V1 as kdsp
+
+# Recall@k report of the approximate similar-user search (ann.py) against the exact search, to choose its parameters
+# for every combination of --bits / --tables / --probes: recall@k, candidates scored per query, query and build time
+# usage: python lsh_recall.py --bits 8,12,16 --tables 4,8,16 --probes 0,1 [--sample 500] [--out report.json]
+# the chosen parameters are set with KDSP_LSH_BITS / KDSP_LSH_TABLES / KDSP_LSH_PROBES (and KDSP_SIMILAR_USERS=lsh)
+
+
+def intList(text):
+    return [int(v) for v in text.split(',')]
+
+
+# Function that returns the recall of each approximate row: the share of its k results scoring at least the k-th exact
+# score (users tied with the k-th exact neighbour count as correct)
+def recall(approx_scores, exact_scores):
+    kth = exact_scores[:, -1:]
+    return ((approx_scores >= kth - 1e-6) & np.isfinite(approx_scores)).sum(axis=1) / exact_scores.shape[1]
+
+
+def report(bits, tables, probes, sample=500, k=10, seed=0):
+    with kdsp.pinned() as t:
+        n_users = len(t['counts']['user_ids'])
+        positions = np.sort(np.random.default_rng(seed).choice(n_users, size=min(sample, n_users), replace=False))
+
+        start = time.perf_counter()
+        _, exact_scores = kdsp.topKSimilar(positions, k)
+        exact_ms = (time.perf_counter() - start) * 1000 / len(positions)
+
+        rows = []
+        for b in bits:
+            for n_tables in tables:
+                for p in probes:
+                    start = time.perf_counter()
+                    lsh = kdsp.buildUserLSH(t['user_vectors'], b, n_tables, p)
+                    build_s = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    _, scores = lsh.query(positions, k)
+                    query_ms = (time.perf_counter() - start) * 1000 / len(positions)
+
+                    candidates = [len(lsh.candidates(h)) - 1 for h in lsh.hash(positions)]
+                    rows.append({
+                        'bits': b, 'tables': n_tables, 'probes': p,
+                        'recall': float(recall(scores, exact_scores).mean()),
+                        'candidates': float(np.mean(candidates)),
+                        'candidate_share': float(np.mean(candidates)) / (n_users - 1),
+                        'query_ms': query_ms,
+                        'build_s': build_s,
+                    })
+                    print("bits %3d  tables %3d  probes %d   recall@%d %.3f   candidates %8.1f (%5.1f%%)   %.3f ms/query"
+                          % (b, n_tables, p, k, rows[-1]['recall'], rows[-1]['candidates'], 100 * rows[-1]['candidate_share'],
+                             query_ms))
+
+        return {'users': n_users, 'sample': len(positions), 'k': k, 'exact_ms': exact_ms, 'results': rows}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recall@k of the LSH similar-user search against the exact search")
+    parser.add_argument('--bits', type=intList, default=[8, 12, 16])
+    parser.add_argument('--tables', type=intList, default=[4, 8, 16])
+    parser.add_argument('--probes', type=intList, default=[0, 1])
+    parser.add_argument('--sample', type=int, default=500, help="users queried")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    result = report(args.bits, args.tables, args.probes, args.sample, args.k, args.seed)
+    print("exact search: %.3f ms/query over %d users" % (result['exact_ms'], result['users']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,158 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Lightweight in-process metrics: stage timings of the recommenders and request counts,
+# exposed in the Prometheus text format by app.py (/metrics)
+
+# upper bounds (s) of the latency histogram buckets
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+def labelText(names, values):
+    if not names:
+        return ''
+    escaped = [str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values]
+    return '{' + ','.join(n + '="' + v + '"' for n, v in zip(names, escaped)) + '}'
+
+
+# Counter with labels: one value per combination of label values
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, values=(), n=1):
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + n
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' counter']
+        with self.lock:
+            for values, value in sorted(self.values.items()):
+                lines.append(self.name + labelText(self.labels, values) + ' ' + repr(value))
+        return lines
+
+
+# Histogram with labels: bucket counts, sum and count per combination of label values
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (+Inf last), sum]
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, values=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' histogram']
+        with self.lock:
+            for values, (counts, total) in sorted(self.series.items()):
+                # Prometheus buckets are cumulative
+                cumulative = 0
+                for bound, count in zip(self.buckets + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append(self.name + '_bucket' + labelText(self.labels + ('le',), values + (bound,)) + ' ' + str(cumulative))
+                lines.append(self.name + '_sum' + labelText(self.labels, values) + ' ' + repr(total))
+                lines.append(self.name + '_count' + labelText(self.labels, values) + ' ' + str(cumulative))
+        return lines
+
+
+stage_seconds = Histogram('kdsp_stage_seconds', "Duration of each stage of the recommenders", ('stage',))
+requests_total = Counter('kdsp_requests_total', "HTTP requests served", ('endpoint', 'method', 'status'))
+request_seconds = Histogram('kdsp_request_seconds', "Duration of HTTP requests (until the first byte for streamed responses)",
+                            ('endpoint',))
+
+
+# Function (context manager) that records the duration of the block as one observation of a stage
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, (name,))
+
+
+# Function (decorator) that records every call of the decorated function as a stage (named after the function by default)
+def timed(name=None):
+    def decorate(fn):
+        label = (name or fn.__name__,)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stage_seconds.observe(time.perf_counter() - start, label)
+        return wrapper
+    return decorate
+
+
+# Function that returns the counters of result caches (result_cache.ResultCache) as metric lines
+# caches: {name: cache}
+def cacheLines(caches):
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    lines = []
+    for key, kind, help in [('hits', 'counter', "Cache lookups answered from the cache"),
+                            ('misses', 'counter', "Cache lookups not answered from the cache"),
+                            ('evictions', 'counter', "Entries evicted to fit the memory budget"),
+                            ('expirations', 'counter', "Entries dropped after their TTL"),
+                            ('entries', 'gauge', "Entries in the cache"),
+                            ('bytes', 'gauge', "Estimated size of the cache"),
+                            ('max_bytes', 'gauge', "Memory budget of the cache")]:
+        name = 'kdsp_cache_' + key + ('_total' if kind == 'counter' else '')
+        lines += ['# HELP ' + name + ' ' + help, '# TYPE ' + name + ' ' + kind]
+        lines += [name + labelText(('cache',), (cache,)) + ' ' + str(s[key]) for cache, s in stats.items()]
+    return lines
+
+
+# Function that returns one gauge with one label as metric lines; values: {label value: value}
+def gaugeLines(name, help, label, values):
+    lines = ['# HELP ' + name + ' ' + help, '# TYPE ' + name + ' gauge']
+    return lines + [name + labelText((label,), (key,)) + ' ' + str(value) for key, value in sorted(values.items())]
+
+
+# Function that returns one counter with one label as metric lines; values: {label value: value}
+def counterLines(name, help, label, values):
+    lines = ['# HELP ' + name + ' ' + help, '# TYPE ' + name + ' counter']
+    return lines + [name + labelText((label,), (key,)) + ' ' + str(value) for key, value in sorted(values.items())]
+
+
+# Function that renders every metric in the Prometheus text format
+def render(caches=None):
+    lines = stage_seconds.render() + requests_total.render() + request_seconds.render() + cacheLines(caches or {})
+    return '\n'.join(lines) + '\n'
+
+
+# Function that adds labels to every sample of metrics text (e.g. the worker process that rendered it)
+def addLabels(text, names, values):
+    extra = labelText(names, values)[1:-1]
+    lines = []
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            brace, space = line.find('{'), line.find(' ')
+            if 0 <= brace < space:
+                line = line[:brace + 1] + extra + ',' + line[brace + 1:]
+            else:
+                line = line[:space] + '{' + extra + '}' + line[space:]
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,108 @@
+import csv
+import json
+import numpy as np
+import KDSP_Task3_V1 as kdsp
+
+# One recommendation query as a dict (used by the batch job and the result store):
+#   task 1: {"task": 1, "uid": 5, "category": "Bar"}
+#   task 2: {"task": 2, "uid": 5}
+#   task 3: {"task": 3, "uids": [1, 2, 3, 4, 5], "locs": [[40.7, -74.0], ...]}  (one location per user)
+#           with "k": 10, the 10 best meeting venues instead of the meeting point
+#   tasks 1 and 2 take an optional time window in local time, end excluded (either end may be null):
+#           {"task": 2, "uid": 5, "window": ["2012-06-01", "2012-09-01"]}  (see KDSP_Task3_V1.parseWindow)
+
+
+# Function that validates a query and returns it in canonical form (raises ValueError if it can not be answered)
+def normalizeQuery(query):
+    task = int(query['task'])
+
+    if task in (1, 2):
+        uid = int(query['uid'])
+        if kdsp.checkUserID(uid) is False:
+            raise ValueError("UserID " + str(uid) + " could not be accepted")
+        window = dict()
+        if query.get('window') is not None:
+            if len(query['window']) != 2:
+                raise ValueError("the time window must be [start, end]")
+            window = {'window': list(kdsp.parseWindow(query['window']))}
+        if task == 2:
+            return {'task': 2, 'uid': uid, **window}
+
+        if (category := kdsp.checkCategory(str(query['category']))) is False:
+            raise ValueError("no category matches " + repr(query['category']))
+        return {'task': 1, 'uid': uid, 'category': category, **window}
+
+    if task == 3:
+        uids = [int(uid) for uid in query['uids']]
+        locs = [[float(lat), float(lon)] for lat, lon in query['locs']]
+        if len(uids) == 0 or len(uids) != len(locs):
+            raise ValueError("task 3 needs one location per UserID")
+        for uid in uids:
+            if kdsp.checkUserID(uid) is False:
+                raise ValueError("UserID " + str(uid) + " could not be accepted")
+        for lat, lon in locs:
+            if not kdsp.checkLocation(lat, lon):
+                raise ValueError("location outside the area of the dataset: " + str([lat, lon]))
+        if 'k' in query:
+            k = int(query['k'])
+            if not 1 <= k <= 100:
+                raise ValueError("k must be in 1 to 100")
+            return {'task': 3, 'uids': uids, 'locs': locs, 'k': k}
+        return {'task': 3, 'uids': uids, 'locs': locs}
+
+    raise ValueError("unknown task " + str(task))
+
+
+# Function that returns the key of a canonical query in the result store
+def queryKey(query):
+    window = [query['window']] if 'window' in query else []
+    if query['task'] == 1:
+        return kdsp.resultKey(1, query['uid'], query['category'], *window)
+    if query['task'] == 2:
+        return kdsp.resultKey(2, query['uid'], *window)
+    if 'k' in query:
+        return kdsp.resultKey(3, query['uids'], query['locs'], query['k'])
+    return kdsp.resultKey(3, query['uids'], query['locs'])
+
+
+# Function that computes the result of a canonical query (JSON-compatible)
+def runQuery(query):
+    if query['task'] == 1:
+        return kdsp.recommendVenueFromIDandCategory(query['uid'], query['category'], query.get('window'))
+    if query['task'] == 2:
+        return kdsp.recommendUsersFromID(query['uid'], query.get('window'))
+    if 'k' in query:
+        return kdsp.recommendMeetingVenues(query['uids'], query['locs'], query['k'])
+    return kdsp.recommendMeetingPointFromIDsandLocs(query['uids'], np.array(query['locs'])).tolist()
+
+
+# Function that computes the results of many canonical queries of one task in one batch
+def runQueries(task, batch):
+    # queries with a time window are answered one by one
+    if task == 3 or any('window' in query for query in batch):
+        return [runQuery(query) for query in batch]
+    if task == 1:
+        return kdsp.recommendVenuesBatch([(query['uid'], query['category']) for query in batch])
+    if task == 2:
+        return kdsp.similarUsers([query['uid'] for query in batch], 10)
+
+
+# Function that parses one line of a query file: a JSON object, or a CSV row with the columns
+# task,uid,category,uids,locs  (uids: "1 2 3 4 5", locs: "lat lon;lat lon;...")
+def parseQueryLine(line, csv_columns=None):
+    line = line.strip()
+    if line.startswith('{'):
+        return json.loads(line)
+
+    values = next(csv.reader([line]))
+    row = dict(zip(csv_columns or ['task', 'uid', 'category', 'uids', 'locs'], values))
+    query = {'task': row['task']}
+    if row.get('uid'):
+        query['uid'] = row['uid']
+    if row.get('category'):
+        query['category'] = row['category']
+    if row.get('uids'):
+        query['uids'] = row['uids'].replace(',', ' ').split()
+    if row.get('locs'):
+        query['locs'] = [loc.replace(',', ' ').split() for loc in row['locs'].split(';')]
+    return query
@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import KDSP_Task3_V1 as kdsp
+import queries
+from batch_recommend import readQueries, chunked
+from benchmark import peakRSS
+from result_store import ResultStore
+
+# Non-interactive command line recommender (instead of the input() prompts of recommend_1 / 2 / 3):
+# queries are read from a file or stdin (JSON lines or CSV: see queries.py) and answered lazily, one JSON line each
+# written as soon as it is computed, in input order:
+#   {"index": 0, "query": {...}, "result": ...} or {"index": 1, "error": "..."}
+# the data is loaded once at start; every stage is a generator, so memory stays constant however long the input is
+# usage:
+#   python recommend_stream.py queries.jsonl > results.jsonl
+#   cat replay.jsonl | python recommend_stream.py --chunk 256 --city tky
+
+
+# Function that answers a chunk of queries: the valid ones of each task are computed in one batch (missing ones only,
+# see kdsp.cachedResults) and the answers are returned in input order
+def answerChunk(chunk, start):
+    lines = [None] * len(chunk)
+    by_task = dict()
+    for i, query in enumerate(chunk):
+        if isinstance(query, ValueError):
+            # a line that could not be parsed
+            lines[i] = {'index': start + i, 'error': str(query)}
+            continue
+        try:
+            query = queries.normalizeQuery(query)
+            by_task.setdefault(query['task'], []).append((i, query))
+        except (ValueError, KeyError, TypeError) as e:
+            lines[i] = {'index': start + i, 'error': str(e)}
+
+    for task, valid in sorted(by_task.items()):
+        keys = [queries.queryKey(query) for _, query in valid]
+        results = kdsp.cachedResults(keys, lambda positions: queries.runQueries(task, [valid[p][1] for p in positions]))
+        for (i, query), result in zip(valid, results):
+            lines[i] = {'index': start + i, 'query': query, 'result': result}
+    return lines
+
+
+# Function that answers the queries lazily, chunk by chunk, on the tables of one city (pinned for each chunk)
+def answerQueries(items, shard, chunk_size=1, stats=None):
+    stats = stats if stats is not None else dict()
+    start = 0
+    for chunk in chunked(items, chunk_size):
+        with kdsp.pinned(shard):
+            lines = answerChunk(chunk, start)
+        start += len(chunk)
+        stats['queries'] = stats.get('queries', 0) + len(lines)
+        stats['errors'] = stats.get('errors', 0) + sum('error' in line for line in lines)
+        yield lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Answer recommendation queries from a file or stdin as JSON lines")
+    parser.add_argument('queries', nargs='?', default='-', help="query file (JSON lines or CSV, default '-': stdin)")
+    parser.add_argument('--out', help="write the answers to this file (default: stdout)")
+    parser.add_argument('--chunk', type=int, default=1,
+                        help="queries computed together (more: faster batch computation, answers written per chunk)")
+    parser.add_argument('--city', help="city of the queries (default: the default city, see shards.py)")
+    parser.add_argument('--store', help="also read and fill this result store (see batch_recommend.py)")
+    args = parser.parse_args()
+
+    try:
+        shard = kdsp.shardTables(args.city)
+    except KeyError:
+        parser.error("unknown city " + args.city)
+    if args.store:
+        kdsp.result_store = ResultStore(args.store)
+
+    stats = dict()
+    start = time.perf_counter()
+    out = open(args.out, 'w', encoding='utf-8') if args.out else sys.stdout
+    try:
+        for lines in answerQueries(readQueries(args.queries, yield_errors=True), shard, max(args.chunk, 1), stats):
+            out.write(''.join(json.dumps(line) + '\n' for line in lines))
+            out.flush()
+    except BrokenPipeError:
+        # the reader stopped (e.g. | head): stop quietly (stdout goes to devnull so the exit does not fail to flush it)
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    stats['peak_rss_mb'] = peakRSS()
+    print(json.dumps(stats), file=sys.stderr)
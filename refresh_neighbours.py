@@ -0,0 +1,15 @@
+import sys
+import KDSP_Task3_V1 as kdsp
+
+# Offline job: rebuild the top-n similar users table used by Task 2 (/method2) and save it next to the dataset
+# usage: python refresh_neighbours.py [n] [--lsh]
+#   --lsh: approximate search (see ann.py), for datasets with too many users to score every pair
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--lsh']
+    n = int(args[0]) if args else kdsp.NEIGHBOURS_N
+
+    table = kdsp.buildNeighbourTable(n, approximate='--lsh' in sys.argv)
+    kdsp.saveNeighbourTable(table)
+
+    print("saved " + str(table['ids'].shape[0]) + " users x " + str(n) + " neighbours to " + kdsp.NEIGHBOURS_PATH)
@@ -0,0 +1,70 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# bytes counted per entry on top of its key and JSON-encoded value (dict slot, tuple, timestamps)
+ENTRY_OVERHEAD = 200
+
+
+# Bounded in-memory LRU cache with a TTL, for recommendation results
+# max_bytes: memory budget (entry size estimated from its JSON encoding), ttl: seconds an entry stays valid (None = forever)
+class ResultCache:
+
+    def __init__(self, max_bytes=64 * 2**20, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    # Function that returns the cached value of key, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+
+            value, size, expires = entry
+            if expires is not None and expires < time.monotonic():
+                self.remove(key)
+                self.counters['expirations'] += 1
+                self.counters['misses'] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        size = len(repr(key)) + len(json.dumps(value, default=str)) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            expires = None if self.ttl is None else time.monotonic() + self.ttl
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+
+            # evict the least recently used entries until the cache fits its budget
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    # Function that returns the counters and the current size of the cache
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.bytes, max_bytes=self.max_bytes)
@@ -0,0 +1,168 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# On-disk store of precomputed recommendation results (sqlite, one row per query)
+# results are keyed by (dataset fingerprint, query key), so a reloaded / different dataset never reads older results
+# (the app uses the store only for the dataset as loaded, see KDSP_Task3_V1.cachedResults).
+# results, jobs and maps written by the app (putLater, putJob, putMap) go through a background thread, so requests never
+# wait for sqlite; the oldest results are deleted beyond max_rows, and expired jobs and maps on a timer (see expire)
+
+RESULTS_PATH = "Project3_Data/results.sqlite"
+MAX_ROWS = int(os.environ.get('KDSP_RESULTS_ROWS', 1000000))
+# seconds the background writer waits to gather more results into one transaction
+WRITE_DELAY = 0.5
+# interval (s) at which the background writer deletes the expired jobs and maps
+EXPIRE_INTERVAL = 60
+# longest wait (s) of a reader for a job / map another worker has queued but not written yet
+READ_WAIT = 1.0
+
+
+class ResultStore:
+
+    def __init__(self, path=RESULTS_PATH, max_rows=MAX_ROWS):
+        self.path = path
+        self.max_rows = max_rows
+        # one connection per thread (sqlite connections can not be shared between threads)
+        self.local = threading.local()
+        # results waiting for the background writer (started on first use in each process)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        # set when jobs or maps are queued: other workers look them up, so they are written without WRITE_DELAY
+        self.urgent = False
+        self.writer_pid = None
+        # time to live (s) of the jobs and maps, and time they were last expired (see expire)
+        self.ttl = {'jobs': 600, 'maps': 3600}
+        self.expired = time.time()
+        atexit.register(self.flush)
+        with self.connection() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "fingerprint TEXT, key TEXT, value TEXT, created REAL, PRIMARY KEY (fingerprint, key)) WITHOUT ROWID")
+            # stores written before rows had a creation time
+            if 'created' not in [row[1] for row in con.execute("PRAGMA table_info(results)")]:
+                con.execute("ALTER TABLE results ADD COLUMN created REAL DEFAULT 0")
+            con.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created)")
+            # asynchronous jobs (app.py): any worker process can pick up a job submitted to another one
+            con.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, created REAL, value TEXT) WITHOUT ROWID")
+            con.execute("CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)")
+            # Task 3 maps (KDSP_Task3_V1.recommend_3_with_param), shown by whichever worker gets the map request
+            con.execute("CREATE TABLE IF NOT EXISTS maps (id TEXT PRIMARY KEY, created REAL, value TEXT) WITHOUT ROWID")
+            con.execute("CREATE INDEX IF NOT EXISTS maps_created ON maps (created)")
+
+    def connection(self):
+        con = getattr(self.local, 'con', None)
+        # a connection opened before a fork (serve.py) is not reused by the forked workers
+        if con is None or self.local.pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=30)
+            # readers (app.py) are not blocked while the batch job writes
+            con.execute("PRAGMA journal_mode=WAL")
+            self.local.con = con
+            self.local.pid = os.getpid()
+        return con
+
+    # Function that returns the stored result of a query, or None
+    def get(self, fingerprint, key):
+        row = self.connection().execute("SELECT value FROM results WHERE fingerprint = ? AND key = ?",
+                                        (fingerprint, key)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # Function that stores many (key, result) pairs in one transaction
+    def putMany(self, fingerprint, items):
+        now = time.time()
+        with self.connection() as con:
+            con.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                            [(fingerprint, key, json.dumps(value, separators=(',', ':')), now) for key, value in items])
+
+    # Function that queues (key, result) pairs for the background writer: the caller (a request) does not wait for sqlite
+    def putLater(self, fingerprint, items):
+        self.queue([('results', (fingerprint, key, json.dumps(value, separators=(',', ':')))) for key, value in items])
+
+    # Function that queues rows (table, row) for the background writer, started on first use in each process
+    def queue(self, rows, urgent=False):
+        with self.lock:
+            self.pending += rows
+            self.urgent = self.urgent or urgent
+            # threads do not survive the fork of serve.py's workers: each process starts its own writer
+            if self.writer_pid != os.getpid():
+                self.writer_pid = os.getpid()
+                threading.Thread(target=self.writeLoop, name='kdsp-store-writer', daemon=True).start()
+        self.wake.set()
+
+    def writeLoop(self):
+        while True:
+            if self.wake.wait(EXPIRE_INTERVAL) and not self.urgent:
+                time.sleep(WRITE_DELAY)
+            self.wake.clear()
+            self.flush()
+            if time.time() - self.expired >= EXPIRE_INTERVAL:
+                self.expire()
+
+    # Function that writes the queued rows (in one transaction) and deletes the oldest results beyond max_rows
+    def flush(self):
+        with self.lock:
+            rows, self.pending, self.urgent = self.pending, [], False
+        if not rows:
+            return
+        now = time.time()
+        with self.connection() as con:
+            con.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                            [row + (now,) for table, row in rows if table == 'results'])
+            for table in ('jobs', 'maps'):
+                con.executemany("INSERT OR REPLACE INTO " + table + " VALUES (?, ?, ?)", [row for name, row in rows if name == table])
+        if any(table == 'results' for table, _ in rows):
+            self.trim()
+
+    # Function that deletes the oldest results while the store holds more than max_rows
+    def trim(self):
+        with self.connection() as con:
+            extra = con.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_rows
+            if extra > 0:
+                con.execute("DELETE FROM results WHERE (fingerprint, key) IN "
+                            "(SELECT fingerprint, key FROM results ORDER BY created LIMIT ?)", (extra,))
+
+    # Function that deletes results of other dataset versions
+    def prune(self, fingerprint):
+        with self.connection() as con:
+            con.execute("DELETE FROM results WHERE fingerprint != ?", (fingerprint,))
+
+    # Function that deletes the jobs and maps older than their time to live (run by the writer every EXPIRE_INTERVAL)
+    def expire(self):
+        now = time.time()
+        with self.connection() as con:
+            for table, ttl in self.ttl.items():
+                con.execute("DELETE FROM " + table + " WHERE created < ?", (now - ttl,))
+        self.expired = now
+
+    # Function that records a job (JSON-compatible dict), kept ttl seconds (written by the background writer)
+    def putJob(self, job_id, record, ttl=600):
+        self.ttl['jobs'] = ttl
+        self.queue([('jobs', (job_id, time.time(), json.dumps(record, separators=(',', ':'))))], urgent=True)
+
+    # Function that returns the record of a job, or None
+    # (waits up to wait seconds for a job just submitted to another worker, whose writer has not written it yet)
+    def getJob(self, job_id, wait=READ_WAIT):
+        return self.waitFor("SELECT value FROM jobs WHERE id = ?", (job_id,), wait)
+
+    # Function that records a Task 3 map (JSON-compatible dict), kept ttl seconds (written by the background writer)
+    def putMap(self, map_id, entry, ttl=3600):
+        self.ttl['maps'] = ttl
+        self.queue([('maps', (map_id, time.time(), json.dumps(entry, separators=(',', ':'))))], urgent=True)
+
+    # Function that returns a Task 3 map recorded less than ttl seconds ago, or None (waits as getJob)
+    def getMap(self, map_id, ttl=3600, wait=READ_WAIT):
+        return self.waitFor("SELECT value FROM maps WHERE id = ? AND created >= ?", (map_id, time.time() - ttl), wait)
+
+    # Function that returns the JSON value of the first row of a query, polling up to wait seconds (None if there is none)
+    def waitFor(self, query, params, wait):
+        deadline = time.time() + wait
+        while True:
+            row = self.connection().execute(query, params).fetchone()
+            if row is not None:
+                return json.loads(row[0])
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.05)
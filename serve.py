@@ -0,0 +1,130 @@
+import argparse
+import gc
+import os
+import signal
+import socket
+import socketserver
+import sys
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+# Production serving: the engine (dataset and derived tables) is loaded once and frozen, then worker processes
+# are forked. The workers share the engine's arrays copy-on-write (the dataset cache is memory-mapped, so its
+# pages are shared by the page cache), so more workers add throughput without adding a copy of the data each.
+# usage: python serve.py --workers 4 --port 8000
+#   uses gunicorn when it is installed, otherwise a small pre-forking server from the standard library
+#   (on systems without fork, e.g. Windows, one threaded process)
+
+
+# Function that loads the app and its engine, then freezes them for sharing between forked workers
+def loadEngine():
+    if os.environ.get('KDSP_FOLLOW'):
+        sys.exit("KDSP_FOLLOW is not supported by serve.py: the workers share one frozen engine")
+
+    # the engine is loaded below, before the fork (no warmup thread may be running when the workers are forked)
+    os.environ['KDSP_WARMUP'] = 'off'
+    import app
+    # other cities to load before the fork, so the workers share them too (KDSP_PRELOAD=tky,osa);
+    # cities loaded later are loaded by each worker on its own
+    for city in filter(None, os.environ.get('KDSP_PRELOAD', '').split(',')):
+        app.kdsp.shardTables(city.strip())
+    app.kdsp.freeze()
+    # move every object loaded so far out of the garbage collector's reach: collections in the workers
+    # would otherwise write to them and copy their pages
+    gc.collect()
+    gc.freeze()
+    return app.app
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+# Function that serves application on an already listening socket (one worker)
+def runWorker(application, sock):
+    host, port = sock.getsockname()[:2]
+    server = ThreadingWSGIServer((host, port), WSGIRequestHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_name = socket.getfqdn(host)
+    server.server_port = port
+    server.setup_environ()
+    server.set_app(application)
+    server.serve_forever()
+
+
+# Function that forks workers accepting on one shared socket, and replaces the workers that exit
+def servePreforked(application, host, port, workers):
+    sock = socket.create_server((host, port), backlog=1024)
+    if not hasattr(os, 'fork'):
+        print("serving on " + host + ":" + str(port) + " (1 process: fork is not available)")
+        runWorker(application, sock)
+        return
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                runWorker(application, sock)
+            finally:
+                os._exit(0)
+        return pid
+
+    children = {spawn() for _ in range(workers)}
+    print("serving on " + host + ":" + str(port) + " with " + str(workers) + " workers")
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        pid, _ = os.wait()
+        children.discard(pid)
+        children.add(spawn())
+
+
+# Function that serves application with gunicorn (pre-fork: the app is already loaded in the master process)
+def serveGunicorn(application, host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', host + ':' + str(port))
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('preload_app', True)
+
+        def load(self):
+            return application
+
+    Server().run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve app.py with pre-forked workers sharing one read-only engine")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=4, help="threads per worker (gunicorn)")
+    parser.add_argument('--no-gunicorn', action='store_true', help="use the standard library server even if gunicorn is installed")
+    args = parser.parse_args()
+
+    if not os.environ.get('KDSP_SECRET_KEY'):
+        print("KDSP_SECRET_KEY is not set: sessions are signed with a random key and do not survive a restart")
+
+    application = loadEngine()
+    try:
+        if args.no_gunicorn:
+            raise ImportError
+        import gunicorn
+    except ImportError:
+        servePreforked(application, args.host, args.port, args.workers)
+    else:
+        serveGunicorn(application, args.host, args.port, args.workers, args.threads)
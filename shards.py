@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from lazy_import import lazyModule
+pd = lazyModule('pandas')
+sparse = lazyModule('scipy.sparse')
+
+# Registry of the datasets served, one shard per city (Project3_Data/datasets.json):
+#   {"default": "nyc",
+#    "cities": {"nyc": {"name": "New York", "path": "Project3_Data/dataset_NYC.txt"},
+#               "tky": {"name": "Tokyo", "path": "Project3_Data/dataset_TKY.txt"}}}
+# each city has its own precomputed tables ("neighbours" / "clusters", by default <data dir>/<city>_neighbours.npz
+# and <city>_clusters.npz). Shards are loaded on their first request and the least recently used ones are
+# dropped when the loaded shards exceed the memory budget.
+
+REGISTRY_PATH = "Project3_Data/datasets.json"
+
+
+# Function that reads the registry file; without one, the registry holds a single city with the given dataset
+def readRegistry(path=REGISTRY_PATH, default_path="Project3_Data/dataset_NYC.txt"):
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            registry = json.load(f)
+    else:
+        registry = {'default': 'nyc', 'cities': {'nyc': {'name': "New York", 'path': default_path,
+                                                         'neighbours': "Project3_Data/neighbours.npz",
+                                                         'clusters': "Project3_Data/clusters.npz"}}}
+
+    for city, entry in registry['cities'].items():
+        entry.setdefault('name', city)
+        entry.update({key: value for key, value in artifactPaths(os.path.join(os.path.dirname(entry['path']), city)).items()
+                      if key not in entry})
+    registry.setdefault('default', next(iter(registry['cities'])))
+    return registry
+
+
+# Function that returns the default paths of the precomputed tables of a dataset: <base>_neighbours.npz, <base>_clusters.npz
+def artifactPaths(base):
+    return {'neighbours': base + '_neighbours.npz', 'clusters': base + '_clusters.npz'}
+
+
+# Function that estimates the memory held by a shard's tables (bytes): arrays, sparse matrices, data frames, indexes
+def tablesBytes(value, seen=None):
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    from scipy.spatial import cKDTree
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes if value.base is None or id(value.base) not in seen else 0
+    if isinstance(value, sparse.csr_matrix):
+        return sum(tablesBytes(array, seen) for array in (value.data, value.indices, value.indptr))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep=True))
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, cKDTree):
+        # points + permutation + about one node per 8 points
+        return value.data.nbytes + value.indices.nbytes + value.n // 8 * 200
+    if isinstance(value, dict):
+        return sum(tablesBytes(v, seen) for v in value.values()) + len(value) * 100
+    if isinstance(value, (list, tuple)):
+        return sum(tablesBytes(v, seen) for v in value) + len(value) * 8
+    if isinstance(value, str):
+        return len(value) + 50
+    if hasattr(value, '__dict__'):
+        return tablesBytes(vars(value), seen)
+    return 0
+
+
+class ShardRegistry:
+
+    # load(entry) builds the tables of a city from its registry entry; budget: memory budget (bytes) of the loaded shards
+    def __init__(self, registry, load, budget):
+        self.registry = registry
+        self.load = load
+        self.budget = budget
+        # city -> (tables, bytes), least recently used first
+        self.shards = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = dict()
+
+    @property
+    def default(self):
+        return self.registry['default']
+
+    # Function that returns the configured cities whose check-in file is present: {city: name}
+    # (a city whose file is missing is not listed; its pages answer 503)
+    def cities(self):
+        return {city: entry['name'] for city, entry in self.registry['cities'].items() if os.path.exists(entry['path'])}
+
+    # Function that returns the registry entry of a city (KeyError if it is not configured)
+    def entry(self, city):
+        return self.registry['cities'][city]
+
+    # Function that returns the tables of a city, loading them on first use (KeyError if the city is not configured)
+    def get(self, city):
+        entry = self.entry(city)
+        with self.lock:
+            if city in self.shards:
+                self.shards.move_to_end(city)
+                return self.shards[city][0]
+            lock = self.loading.setdefault(city, threading.Lock())
+
+        # one load per city at a time; other cities are served meanwhile
+        with lock:
+            with self.lock:
+                if city in self.shards:
+                    return self.shards[city][0]
+            tables = self.load(entry)
+            self.add(city, tables)
+            return tables
+
+    # Function that adds loaded tables to the registry, dropping the least recently used shards over the budget
+    def add(self, city, tables):
+        size = tablesBytes(tables)
+        with self.lock:
+            self.shards[city] = (tables, size)
+            self.shards.move_to_end(city)
+            while len(self.shards) > 1 and sum(s for _, s in self.shards.values()) > self.budget:
+                self.shards.popitem(last=False)
+
+    def loadedTables(self):
+        with self.lock:
+            return [tables for tables, _ in self.shards.values()]
+
+    # Function that returns the loaded shards: {city: bytes}
+    def loaded(self):
+        with self.lock:
+            return {city: size for city, (_, size) in self.shards.items()}
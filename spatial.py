@@ -0,0 +1,186 @@
+import numpy as np
+from lazy_import import lazyModule
+pd = lazyModule('pandas')
+
+# mean earth radius (km), used for haversine distances
+EARTH_RADIUS_KM = 6371.0088
+# venues appended to an index are scanned linearly until they are more than BUFFER_MIN and BUFFER_SHARE of the venues
+# in the trees of their partition; the trees are rebuilt then (so the cost of an append grows with the batch)
+BUFFER_MIN = 256
+BUFFER_SHARE = 0.05
+
+
+# Function that maps (lat, lon) in degrees to points on the unit sphere
+# the straight-line (chord) distance between these points grows with the great-circle distance,
+# so a KD-tree over them answers haversine nearest/radius queries exactly
+def toUnitSphere(coords):
+    lat = np.radians(coords[:, 0])
+    lon = np.radians(coords[:, 1])
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def chordToKm(chord):
+    return 2 * np.arcsin(np.clip(chord / 2, 0, 1)) * EARTH_RADIUS_KM
+
+
+def kmToChord(km):
+    return 2 * np.sin(np.minimum(km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+# Function that returns the great-circle distances (km) between every point of a and every point of b, shaped (len(a), len(b))
+def distanceMatrixKm(a, b):
+    ua, ub = toUnitSphere(np.asarray(a, dtype=np.float64)), toUnitSphere(np.asarray(b, dtype=np.float64))
+    return chordToKm(np.sqrt(np.maximum(2 - 2 * ua @ ub.T, 0)))
+
+
+# Function that projects (lat, lon) to km on a plane tangent at the points' mean latitude (and back)
+# (accurate at the scale of a city)
+def toPlane(coords, lat0):
+    coords = np.asarray(coords, dtype=np.float64)
+    return np.radians(coords) * EARTH_RADIUS_KM * np.array([1.0, np.cos(np.radians(lat0))])
+
+
+def fromPlane(xy, lat0):
+    return np.degrees(xy / (EARTH_RADIUS_KM * np.array([1.0, np.cos(np.radians(lat0))])))
+
+
+# Function that returns the geometric median of points (lat, lon): the point minimising the sum of distances to them
+# (Weiszfeld's algorithm, on the tangent plane)
+def geometricMedian(coords, iterations=200, tol=1e-4):
+    lat0 = np.mean(coords[:, 0])
+    xy = toPlane(coords, lat0)
+    point = xy.mean(axis=0)
+    for _ in range(iterations):
+        dist = np.linalg.norm(xy - point, axis=1)
+        # a point on one of the inputs: keep it away from a division by zero
+        weights = 1 / np.maximum(dist, 1e-9)
+        new = (xy * weights[:, None]).sum(axis=0) / weights.sum()
+        if np.linalg.norm(new - point) < tol:
+            point = new
+            break
+        point = new
+    return fromPlane(point, lat0)
+
+
+# Function that returns the minimax point of points (lat, lon): the centre of their smallest enclosing circle,
+# which minimises the longest distance to them (Badoiu-Clarkson iterations, on the tangent plane)
+def minimaxPoint(coords, iterations=1000):
+    lat0 = np.mean(coords[:, 0])
+    xy = toPlane(coords, lat0)
+    point = xy[0].copy()
+    for i in range(1, iterations + 1):
+        farthest = xy[np.argmax(np.linalg.norm(xy - point, axis=1))]
+        point += (farthest - point) / (i + 1)
+    return fromPlane(point, lat0)
+
+
+# Spatial index over unique venue coordinates, partitioned by VenueCategoryName
+# metric='euclidean': distance in degrees of (lat, lon)
+# metric='haversine': great-circle distance in km
+# the trees of a partition index its first trees[name]['size'] rows; the rows after them (venues appended since the
+# trees were built) are a buffer searched linearly
+class VenueIndex:
+
+    def __init__(self, venues):
+        # venues: data frame with VenueID, VenueCategoryName, Latitude, Longitude (one row per venue)
+        self.venues = venues.reset_index(drop=True)
+        self.coords = self.venues[['Latitude', 'Longitude']].to_numpy(dtype=np.float64)
+
+        # partition None = every venue
+        self.partitions = {None: np.arange(len(self.venues))}
+        for name, rows in self.venues.groupby('VenueCategoryName').indices.items():
+            self.partitions[name] = rows
+
+        self.trees = dict()
+        for name in self.partitions:
+            self.buildTrees(name)
+
+    def buildTrees(self, name):
+        from scipy.spatial import cKDTree
+        coords = self.coords[self.partitions[name]]
+        self.trees[name] = {'euclidean': cKDTree(coords), 'haversine': cKDTree(toUnitSphere(coords)), 'size': len(coords)}
+
+    # Function that returns a new index with venues appended (rows continue after the current ones)
+    # the new venues go to the buffers of their partitions; only a partition whose buffer outgrows its share is
+    # rebuilt, the trees of the others are shared
+    def extended(self, venues):
+        index = VenueIndex.__new__(VenueIndex)
+        start = len(self.venues)
+        index.venues = pd.concat([self.venues, venues[self.venues.columns]], ignore_index=True)
+        index.coords = np.vstack([self.coords, venues[['Latitude', 'Longitude']].to_numpy(dtype=np.float64)])
+        index.partitions = dict(self.partitions)
+        index.trees = dict(self.trees)
+
+        added = {None: np.arange(len(venues))}
+        added.update(venues.reset_index(drop=True).groupby('VenueCategoryName').indices)
+        for name, rows in added.items():
+            old = index.partitions.get(name, np.empty(0, dtype=np.int64))
+            index.partitions[name] = np.concatenate([old, rows + start])
+            indexed = index.trees.get(name, {'size': 0})['size']
+            if len(index.partitions[name]) - indexed > max(BUFFER_MIN, BUFFER_SHARE * indexed):
+                index.buildTrees(name)
+            elif name not in index.trees:
+                index.trees[name] = {'size': 0}
+
+        return index
+
+    # Function that returns (venue rows, distances) of the k venues nearest to point, closest first
+    def nearest(self, point, k=1, category=None, metric='euclidean'):
+        if category not in self.partitions:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        rows = self.partitions[category]
+        trees = self.trees[category]
+        query = self._queryPoint(point, metric)
+        dist, idx = np.empty(0), np.empty(0, dtype=np.int64)
+        if min(k, trees['size']) > 0:
+            dist, idx = trees[metric].query(query, k=[i + 1 for i in range(min(k, trees['size']))])
+
+        # the buffered venues compete with the k nearest of the trees
+        buffered = np.arange(trees['size'], len(rows))
+        if len(buffered) > 0:
+            idx = np.concatenate([idx, buffered])
+            dist = np.concatenate([dist, self._distances(query, rows[buffered], metric)])
+            order = np.argsort(dist, kind='stable')[:k]
+            idx, dist = idx[order], dist[order]
+
+        if metric == 'haversine':
+            dist = chordToKm(dist)
+        return rows[idx], dist
+
+    # Function that returns (venue rows, distances) of every venue within radius of point, closest first
+    # radius: degrees for 'euclidean', km for 'haversine'
+    def within(self, point, radius, category=None, metric='euclidean'):
+        if category not in self.partitions:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        rows = self.partitions[category]
+        trees = self.trees[category]
+        query = self._queryPoint(point, metric)
+        r = kmToChord(radius) if metric == 'haversine' else radius
+
+        idx = np.empty(0, dtype=np.int64)
+        if trees['size'] > 0:
+            idx = np.asarray(trees[metric].query_ball_point(query, r), dtype=np.int64)
+        buffered = np.arange(trees['size'], len(rows))
+        idx = np.concatenate([idx, buffered[self._distances(query, rows[buffered], metric) <= r]])
+        dist = self._distances(query, rows[idx], metric)
+        order = np.argsort(dist, kind='stable')
+        idx, dist = idx[order], dist[order]
+
+        if metric == 'haversine':
+            dist = chordToKm(dist)
+        return rows[idx], dist
+
+    # Function that returns the distances (in the space of the metric's trees) from a query point to venue rows
+    def _distances(self, query, venue_rows, metric):
+        points = self.coords[venue_rows]
+        if metric == 'haversine':
+            points = toUnitSphere(points)
+        return np.sqrt(np.sum((points - query) ** 2, axis=1))
+
+    def _queryPoint(self, point, metric):
+        point = np.asarray(point, dtype=np.float64).reshape(1, 2)
+        if metric == 'haversine':
+            return toUnitSphere(point)[0]
+        return point[0]
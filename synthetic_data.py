@@ -0,0 +1,103 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+# Synthetic check-in generator: writes the 8-column tab separated format of dataset_NYC.txt
+# (UserID, VenueID, VenueCategoryID, VenueCategoryName, Latitude, Longitude, TimezoneOffsetInMin, UTCTime)
+# with skewed distributions like the real data:
+#   - user activity and venue / category popularity follow power laws (a few very active users, a few very popular places)
+#   - venues are clustered around hotspots of the city
+#   - users come back to a few "home" venues
+# usage: python synthetic_data.py out.txt --users 1083 --venues 38333 --categories 400 --checkins 227428
+
+# NYC, as in the original dataset
+CENTER = (40.75, -73.95)
+SPREAD = (0.2, 0.25)
+START = pd.Timestamp('2012-04-03')
+DAYS = 320
+
+
+# Function that returns power law weights 1 / rank^a in a random order (sum = 1)
+def powerLaw(rng, n, a):
+    weights = 1.0 / np.arange(1, n + 1) ** a
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+# Function that returns n random ids of 24 hex characters, like the Foursquare ids
+def hexIDs(rng, n):
+    raw = rng.bytes(12 * n)
+    return np.array([raw[i:i + 12].hex() for i in range(0, 12 * n, 12)])
+
+
+# Function that generates the venues: (VenueID, category index, latitude, longitude, popularity)
+def makeVenues(rng, n_venues, category_weights, hotspots=50):
+    category = rng.choice(len(category_weights), size=n_venues, p=category_weights)
+
+    # hotspots around the city center, the bigger ones holding more venues
+    spots = np.column_stack([rng.normal(CENTER[0], SPREAD[0] / 2, hotspots), rng.normal(CENTER[1], SPREAD[1] / 2, hotspots)])
+    spot = rng.choice(hotspots, size=n_venues, p=powerLaw(rng, hotspots, 1.0))
+    lat = np.clip(spots[spot, 0] + rng.normal(0, 0.02, n_venues), CENTER[0] - SPREAD[0], CENTER[0] + SPREAD[0])
+    lon = np.clip(spots[spot, 1] + rng.normal(0, 0.02, n_venues), CENTER[1] - SPREAD[1], CENTER[1] + SPREAD[1])
+
+    return hexIDs(rng, n_venues), category, np.round(lat, 6), np.round(lon, 6), powerLaw(rng, n_venues, 0.9)
+
+
+# Function that writes a synthetic dataset; returns the number of rows written
+# repeat: share of check-ins at one of the user's 5 home venues
+def generateCheckins(path, users=1083, venues=38333, categories=400, checkins=227428, names=None, repeat=0.4,
+                     seed=0, chunk=1000000):
+    rng = np.random.default_rng(seed)
+
+    # categories: several ids can share a name, as in the real data (400 ids, 251 names)
+    names = names or max(1, int(categories * 0.63))
+    category_ids = hexIDs(rng, categories)
+    category_names = np.array(["Category " + str(i) for i in range(names)])[rng.integers(0, names, categories)]
+    category_names[:names] = ["Category " + str(i) for i in range(min(names, categories))]
+
+    venue_ids, venue_category, lat, lon, popularity = makeVenues(rng, venues, powerLaw(rng, categories, 1.1))
+    activity = powerLaw(rng, users, 0.8)
+    home = rng.choice(venues, size=(users, 5), p=popularity)
+
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < checkins:
+            n = min(chunk, checkins - written)
+            user = rng.choice(users, size=n, p=activity)
+            venue = np.where(rng.random(n) < repeat, home[user, rng.integers(0, 5, n)], rng.choice(venues, size=n, p=popularity))
+            # the file is in time order: each chunk covers its share of the period
+            span = DAYS * 86400 / checkins
+            seconds = np.sort(rng.integers(int(written * span), int((written + n) * span) + 1, n))
+            times = (START + pd.to_timedelta(seconds, unit='s')).strftime('%a %b %d %H:%M:%S +0000 %Y')
+
+            pd.DataFrame({
+                'UserID': user + 1,
+                'VenueID': venue_ids[venue],
+                'VenueCategoryID': category_ids[venue_category[venue]],
+                'VenueCategoryName': category_names[venue_category[venue]],
+                'Latitude': lat[venue],
+                'Longitude': lon[venue],
+                'TimezoneOffsetInMin': np.where(rng.random(n) < 0.8, -240, -300),
+                'UTCTime': times,
+            }).to_csv(f, sep='\t', header=False, index=False)
+            written += n
+
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic check-in dataset in the format of dataset_NYC.txt")
+    parser.add_argument('path')
+    parser.add_argument('--users', type=int, default=1083)
+    parser.add_argument('--venues', type=int, default=38333)
+    parser.add_argument('--categories', type=int, default=400)
+    parser.add_argument('--names', type=int, default=None, help="distinct category names (default: 63%% of --categories)")
+    parser.add_argument('--checkins', type=int, default=227428)
+    parser.add_argument('--repeat', type=float, default=0.4, help="share of check-ins at a user's home venues")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.time()
+    n = generateCheckins(args.path, args.users, args.venues, args.categories, args.checkins, args.names, args.repeat, args.seed)
+    print("wrote " + str(n) + " check-ins to " + args.path + " in %.1f s" % (time.time() - start))